@@ -1,37 +1,218 @@
+import asyncio
+import io
+import tempfile
 import time
-import requests
-from bs4 import BeautifulSoup
+from urllib.parse import parse_qs, urlencode, urlparse
 
 import json
 import csv
 
+CATALOG_URL = "https://catalog.data.gov"
+ACCEPTABLE_FORMATS = ["csv"]
 
-def generate_scraped_urls(topic):
-	ACCEPTABLE_FORMATS = ["csv"]
+JSON_CHUNK_CHARS = 1024 * 1024  # text read at a time from JSON exports
+PARQUET_BATCH_ROWS = 10000
 
-	query = topic.replace(" ", "+")  # "state weather data".replace(" ", "+")
-	params = f"q={query}"
-	for format in ACCEPTABLE_FORMATS:
-		params += f"&res_format={format.upper()}"
-	URL = f"https://catalog.data.gov/dataset/?{params}"
-	print(f"Querying {URL}\n")
 
-	res = requests.get(URL)
+def get_html_parser():
+	# lxml is several times faster than Python's parser, but optional
+	try:
+		import lxml
+		return "lxml"
+	except ImportError:
+		return "html.parser"
 
-	soup = BeautifulSoup(res.text, "html.parser")
-	results = soup("div", class_="dataset-content")
 
-	# -- write all CSV links to a file --
-	file = open("links.txt", "w")
+def parse_results_page(html, parser=None):
+	"""
+	Links to the ACCEPTABLE_FORMATS resources listed on a catalog results page, and
+	the number of the last results page its pagination links to
+	"""
+
+	from bs4 import BeautifulSoup  # imported here so importing the pipeline doesn't load it
+
+	soup = BeautifulSoup(html, parser or get_html_parser())
+
 	links = []
-	for result in results:
-		resources = result.find("ul", class_="dataset-resources")("a", attrs={"data-format": ACCEPTABLE_FORMATS})
-		for resource in resources:
+	for result in soup("div", class_="dataset-content"):
+		resources = result.find("ul", class_="dataset-resources")
+		if resources is None:  # dataset without downloadable resources
+			continue
+		for resource in resources("a", attrs={"data-format": ACCEPTABLE_FORMATS}):
 			links.append(resource["href"])
-	file.write("\n".join(links))
-	file.close()
 
-	return file
+	last_page = 1
+	for page_link in soup.select(".pagination a[href]"):
+		page = parse_qs(urlparse(page_link["href"]).query).get("page", [""])[0]
+		if page.isdigit():
+			last_page = max(last_page, int(page))
+
+	return links, last_page
+
+
+class CatalogCrawler:
+	"""
+	Crawls the catalog's search results for a topic, following its pagination.
+	Result pages are fetched concurrently (at most `max_concurrency` at once, starting
+	at least `delay` seconds apart to be polite to the server) and each resource link
+	is yielded once, as soon as the page listing it arrives. Every results page is
+	crawled, up to the last one any page's pagination links to, until a page has no
+	new results; `max_pages` caps the number of pages.
+
+	Pages are kept in the download cache (`cache`, or the process-wide one), so a
+	rerun only revalidates (or, while they're fresh, doesn't request) them. Set
+	`use_cache` to False to bypass it.
+
+	`base_url` and `client` (an httpx.AsyncClient) can be injected, e.g. to crawl saved
+	pages served locally; a client created here is closed with the crawler.
+	"""
+
+	def __init__(self, base_url=CATALOG_URL, client=None, max_concurrency=4, delay=0.5, max_pages=None, timeout=30.0, parser=None, cache=None, use_cache=True):
+		from file_processing.utils.download_cache import get_download_cache  # imports the compression modules
+
+		self.cache = (cache or get_download_cache()) if use_cache else None
+		self.base_url = base_url.rstrip("/")
+		self.max_concurrency = max_concurrency
+		self.delay = delay
+		self.max_pages = max_pages
+		self.parser = parser or get_html_parser()
+		self.pages_fetched = 0
+
+		self._owns_client = client is None
+		if client is None:
+			import httpx
+			client = httpx.AsyncClient(follow_redirects=True, timeout=timeout)
+		self.client = client
+
+		self._semaphore = None
+		self._turn_lock = None
+		self._next_request = 0.0
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def close(self):
+		if self._owns_client:
+			await self.client.aclose()
+
+	def page_url(self, topic, page=1):
+		params = [("q", topic)] + [("res_format", format.upper()) for format in ACCEPTABLE_FORMATS]
+		if page > 1:
+			params.append(("page", page))
+		return f"{self.base_url}/dataset/?{urlencode(params)}"
+
+	async def _wait_turn(self):
+		async with self._turn_lock:
+			wait = self._next_request - time.monotonic()
+			if wait > 0:
+				await asyncio.sleep(wait)
+			self._next_request = time.monotonic() + self.delay
+
+	async def fetch_page(self, topic, page):
+		"""
+		Resource links on results page `page` and the last page number it links to
+		"""
+
+		# created lazily so they bind to the running event loop
+		if self._semaphore is None:
+			self._semaphore = asyncio.Semaphore(self.max_concurrency)
+			self._turn_lock = asyncio.Lock()
+
+		url = self.page_url(topic, page)
+		cached = self.cache.cached(url) if self.cache is not None else None
+		if cached is None:
+			async with self._semaphore:
+				await self._wait_turn()
+				headers = self.cache.conditional_headers(url) if self.cache is not None else {}
+				res = await self.client.get(url, headers=headers)
+				self.pages_fetched += 1
+			if res.status_code == 304:
+				self.cache.mark_revalidated(url)
+				cached = self.cache.cached(url)
+			else:
+				res.raise_for_status()
+				if self.cache is not None:
+					self.cache.put(url, res.content, res.headers)
+				cached = res.content, True
+		return parse_results_page(cached[0], self.parser)
+
+	async def crawl(self, topic):
+		"""
+		Yield each resource link found for `topic`, once, as result pages arrive
+		"""
+
+		import httpx
+
+		seen = set()
+
+		def new_links(links):
+			for link in links:
+				if link not in seen:
+					seen.add(link)
+					yield link
+
+		async def fetch(page):
+			return page, await self.fetch_page(topic, page)
+
+		links, last_page = await self.fetch_page(topic, 1)
+		found = list(new_links(links))
+		for link in found:
+			yield link
+
+		# pagination may only link to a window of pages, so each page can extend the crawl
+		end, scheduled = last_page if found else 1, 1
+		tasks = set()
+
+		def schedule():
+			nonlocal scheduled
+			while scheduled < end and (self.max_pages is None or scheduled < self.max_pages):
+				scheduled += 1
+				tasks.add(asyncio.ensure_future(fetch(scheduled)))
+
+		schedule()
+		try:
+			while tasks:
+				done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					tasks.discard(task)
+					try:
+						page, (links, last_page) = task.result()
+					except httpx.HTTPError as e:
+						print(f"unable to get results page:\n\t{e!r}")
+						continue
+
+					found = list(new_links(links))
+					for link in found:
+						yield link
+					# a page without new results is past the end of the results
+					end = max(end, last_page) if found else min(end, page)
+				schedule()
+		finally:
+			for task in tasks:
+				task.cancel()
+
+
+def generate_scraped_urls(topic, output_file="links.txt", **crawler_kwargs):
+	"""
+	Write the links to CSV files the catalog lists for `topic` to `output_file`, one
+	per line, as they're found. Keyword arguments configure the CatalogCrawler.
+	Returns `output_file`.
+	"""
+
+	async def crawl(file):
+		async with CatalogCrawler(**crawler_kwargs) as crawler:
+			print(f"Querying {crawler.page_url(topic)}\n")
+			async for link in crawler.crawl(topic):
+				file.write(link + "\n")
+				file.flush()
+
+	with open(output_file, "w") as file:
+		asyncio.run(crawl(file))
+
+	return output_file
 
 
 # -- download the CSV files reachable from the first page --
@@ -84,16 +265,179 @@ def read_column_headers_from_csv(csv_string):
 	return next(reader)
 
 
-def json_to_csv(json_string):
-	data = json.loads(json_string)
-	csv_data = csv.writer(open("data.csv", "w"))
+def iter_socrata_json(stream, chunk_chars=JSON_CHUNK_CHARS):
+	"""
+	Incrementally parse a Socrata JSON export ({"meta": {"view": {"columns": [...]}},
+	"data": [[...], ...]}) read from a text stream. Yields ("meta", meta) once the meta
+	object has been read and ("row", row) for each data row, so only one row (and a
+	chunk of text) is held in memory at a time rather than the whole export.
+	"""
+
+	decoder = json.JSONDecoder()
+	buf, pos, eof = "", 0, False
+
+	def fill():
+		nonlocal buf, pos, eof
+		chunk = stream.read(chunk_chars)
+		if not chunk:
+			eof = True
+		buf, pos = buf[pos:] + chunk, 0
+
+	def next_char():
+		# first character of the next token, without consuming it
+		nonlocal pos
+		while True:
+			while pos < len(buf) and buf[pos] in " \t\r\n":
+				pos += 1
+			if pos < len(buf):
+				return buf[pos]
+			if eof:
+				raise ValueError("unexpected end of JSON export")
+			fill()
+
+	def value():
+		nonlocal pos
+		next_char()
+		while True:
+			try:
+				obj, end = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+			else:
+				if end < len(buf) or eof:  # a number at the end of the buffer may continue
+					pos = end
+					return obj
+			fill()
+
+	def expect(char):
+		nonlocal pos
+		if next_char() != char:
+			raise ValueError(f"expected '{char}' at '{buf[pos:pos + 20]}'")
+		pos += 1
+
+	expect("{")
+	while next_char() != "}":
+		if next_char() == ",":
+			pos += 1
+		key = value()
+		expect(":")
+		if key == "data" and next_char() == "[":
+			pos += 1
+			while next_char() != "]":
+				if next_char() == ",":
+					pos += 1
+				yield "row", value()
+			pos += 1
+		elif key == "meta":
+			yield "meta", value()
+		else:
+			value()
+
+
+def _cell(value):
+	# nested values (locations, urls) are written as JSON
+	if value is None or isinstance(value, str):
+		return value
+	return json.dumps(value)
+
+
+class _CSVRowWriter:
+	def __init__(self, path, columns):
+		self.file = open(path, "w", newline="")
+		self.writer = csv.writer(self.file)
+		self.writer.writerow(columns)
+
+	def write(self, row):
+		self.writer.writerow([_cell(value) for value in row])
+
+	def close(self):
+		self.file.close()
+
+
+class _ParquetRowWriter:
+	def __init__(self, path, columns, batch_rows):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+
+		self.pa = pa
+		self.columns = columns
+		self.batch_rows = batch_rows
+		self.schema = pa.schema([(column, pa.string()) for column in columns])
+		self.writer = pq.ParquetWriter(path, self.schema)
+		self.batch = []
+
+	def write(self, row):
+		self.batch.append(row)
+		if len(self.batch) >= self.batch_rows:
+			self.flush()
+
+	def flush(self):
+		if self.batch:
+			arrays = [[_cell(row[i]) if i < len(row) else None for row in self.batch] for i in range(len(self.columns))]
+			self.writer.write_table(self.pa.Table.from_arrays([self.pa.array(values, self.pa.string()) for values in arrays], schema=self.schema))
+			self.batch = []
+
+	def close(self):
+		self.flush()
+		self.writer.close()
+
+
+def socrata_json_to_table(source, output_file="data.csv", batch_rows=PARQUET_BATCH_ROWS):
+	"""
+	Convert a Socrata JSON export (a path, URL or text stream; optionally compressed)
+	to a CSV file, or a Parquet file if `output_file` ends in .parquet (needs pyarrow),
+	streaming its rows so memory stays bounded however large the export is. The
+	header comes from meta.view.columns. Returns `output_file`.
+	"""
+
+	from table_joins.table_metadata import detect_compression, open_binary
+
+	if isinstance(source, str):
+		if source.startswith(("http://", "https://")):
+			from file_processing.utils.download_cache import open_url
+			binary = io.BufferedReader(open_url(source))
+		else:
+			binary = open(source, "rb")
+		stream = io.TextIOWrapper(open_binary(binary, detect_compression(source, binary.peek(8)[:8])), encoding="utf-8-sig")
+	else:
+		stream = source
+
+	writer = None
+	early_rows = None  # rows that came before meta, spooled to disk
+	try:
+		for kind, item in iter_socrata_json(stream):
+			if kind == "row" and writer is not None:
+				writer.write(item)
+			elif kind == "row":
+				if early_rows is None:
+					early_rows = tempfile.TemporaryFile("w+")
+				early_rows.write(json.dumps(item) + "\n")
+			elif writer is None:
+				columns = [column["name"] for column in item["view"]["columns"]]
+				if output_file.endswith(".parquet"):
+					writer = _ParquetRowWriter(output_file, columns, batch_rows)
+				else:
+					writer = _CSVRowWriter(output_file, columns)
+				if early_rows is not None:
+					early_rows.seek(0)
+					for line in early_rows:
+						writer.write(json.loads(line))
+		if writer is None:
+			raise ValueError("JSON export has no meta.view.columns")
+	finally:
+		if writer is not None:
+			writer.close()
+		if early_rows is not None:
+			early_rows.close()
+		if stream is not source:
+			stream.close()
+
+	return output_file
 
-	columns = data["meta"]["view"]["columns"]
-	csv_data.writerow([column["name"] for column in columns])
 
-	for row in data["data"]:
-		csv_data.writerow(row)
+def json_to_csv(json_string, output_file="data.csv"):
+	return socrata_json_to_table(io.StringIO(json_string), output_file)
 
 
-# with open("Electric Vehicle Population Data.json", "r") as data:
-# 	json_to_csv(data.read())
+# socrata_json_to_table("Electric Vehicle Population Data.json", "Electric Vehicle Population Data.csv")
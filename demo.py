@@ -1,29 +1,24 @@
 import json
-import openai
-from dotenv import load_dotenv
 
 import sys
 import os
 
 sys.path.append(os.getcwd() + "/table_joins")
 
-# Now you can import your module
-from table_joins.multi_table_join import MultiTableJoin
-from table_joins.single_table_filter import SingleTableFilter
-from table_joins import manual_join, gpt_join
-
-load_dotenv()
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-
+# the pipeline modules (pandas, scipy, GloVe, openai) are imported where they're used,
+# so `--help` and short runs don't pay for them at startup
 from er_schema_normalization.er_types import *
 from er_schema_normalization.helpers import run
 
-from data_collection.scraper import generate_scraped_urls
-from file_processing.create_er_csv import generate_smart_data
-
 DATA_PATH = "./demo_data/"
 OUTPUT_PATH = "./demo_results/"
 
+USAGE = """usage: python demo.py [--gpt-headers] [--gpt-join]
+
+  --gpt-headers  use the GPT-suggested headers of the demo data
+  --gpt-join     ask GPT which columns to join the demo data on
+"""
+
 def create_demo_schema():
     """
     Generate and save to a file the set of normalized tables.
@@ -78,6 +73,21 @@ def get_schema_headers(schema_file):
         }
 
 
+def get_schema_types(schema_file):
+    """
+    Currently only supports one normalized table - map its column headers to their
+    type names (e.g. "int", "float", "str")
+    """
+
+    with open(schema_file, 'rb') as file:
+        schema = json.load(file)
+
+    if schema:
+        first_table = next(iter(schema))
+        return dict(schema[first_table])
+    return {}
+
+
 def get_scraper_topic_no_gpt(table_headers):
     """
     Given the column headers from our normalized tables as input,
@@ -93,10 +103,11 @@ def get_scraper_topic(table_headers, n_words=6):
     generate a topic for the scraper to search on
     """
 
-    client = openai.OpenAI(api_key = OPENAI_API_KEY)
+    from table_joins.llm_client import cached_chat_completion
+
     gpt_input = " ".join(table_headers)
 
-    response = client.chat.completions.create(
+    return cached_chat_completion(
         model="gpt-4",
         messages=[
         {"role": "system",
@@ -106,11 +117,19 @@ def get_scraper_topic(table_headers, n_words=6):
         max_tokens=256
     )
 
-    return response.choices[0].message.content
-
 
 def main():
     flags = sys.argv[1:]
+    if "--help" in flags or "-h" in flags:
+        print(USAGE)
+        return
+
+    from dotenv import load_dotenv
+    from table_joins.csv_helpers import get_read_dtypes
+    from table_joins.multi_table_join import MultiTableJoin
+    from table_joins.single_table_filter import SingleTableFilter
+
+    load_dotenv()
 
     print("=" * 80 + "\n")
     _, schema_file = create_demo_schema()
@@ -131,16 +150,21 @@ def main():
     print()
 
     if "--gpt-join" in flags:
+        from table_joins import gpt_join
         plan = gpt_join.plan_join(files, schema_headers, verbose=False)
     else:
+        from table_joins import manual_join
         plan = manual_join.plan_join(files, schema_headers, verbose=True)
 
 
+    # parse matched columns straight into their schema types
+    dtypes = get_read_dtypes(get_schema_types(schema_file), plan["files_to_matches"], plan["intersections"])
+
     if plan["intersections"] is None:  # no join needed
-        join = SingleTableFilter(plan["files_to_matches"], schema_headers)
+        join = SingleTableFilter(plan["files_to_matches"], schema_headers, dtypes=dtypes)
     else:
         join = MultiTableJoin(
-            plan["intersections"], schema_headers, plan["files_to_matches"]
+            plan["intersections"], schema_headers, plan["files_to_matches"], dtypes=dtypes
         )
 
     # filename indicates set of flags used to generate output
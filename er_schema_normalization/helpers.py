@@ -1,6 +1,5 @@
 from er_schema_normalization.er_types import *
 import json
-import erdantic as erd
 import os
 import time
 
@@ -99,6 +98,6 @@ def run(schema_name: str, er_schema: ERSchema):
     # Save erdantic diagram
     # package_schema_name = f'output.{schema_name}.{run_time}'
     # animals_models = importlib.import_module(f'.{schema_name}_models', package=package_schema_name)
-    # erd.draw(animals_models.DATASET, out=f'{schema_name}_diagram.png')
+    # import erdantic as erd; erd.draw(animals_models.DATASET, out=f'{schema_name}_diagram.png')
 
     return (OUTPUT_DIR, FILEPATH)
@@ -1,56 +1,19 @@
 import csv
-import requests
+import io
 import time
-import subprocess
+from contextlib import closing
+from itertools import islice
 
-from file_processing.utils.glove_col_similarity import *
+from file_processing.utils.dataset_ranker import DEFAULT_TOP_K, get_dataset_ranker
+from file_processing.utils.download_cache import SourceChangedError, open_url
+from table_joins.table_metadata import detect_compression, open_binary
 
-def get_headers(scrape_result_file, timeout=5):
-    """
-    Given a list of CSVs from scraping, extract and yield headers from each file
-    Restrict to a default 5-second timeout limit to prevent hanging
-
-    Parameters:
-    - scrape_result_file (str): File containing newline-separated URLs,
-        each enabling CSV file download
-
-    Yields:
-    - url (str): URL enabling CSV file download
-    - headers (list): the column headers within the CSV file at 'url'
-    """
-
-    with open(scrape_result_file, 'r', encoding='utf-8-sig') as f:
-        header_info = []
-
-        for scraped_url in f:
-            url = scraped_url.strip()
-            content = None
-
-            try:
-                result = subprocess.run(["curl", url], capture_output=True, text=True, timeout=timeout)
-                if result.returncode == 0:
-                    content = result.stdout
-
-            except Exception as e:
-                print(f"encountered error when getting from {url}:\n\t{e}")
-                continue
-
-            if content is None:
-                print(f"unable to get data at {url}")
-                continue
-
-            csv_data = list(csv.reader(content.splitlines()))
-            if len(csv_data) == 0:
-                print(f"unable to get data at {url}")
-                continue
-            headers = csv_data[0]
-
-            yield url, headers
-
-def get_best_dataset(schema_headers, scrape_result_file):
+def get_best_dataset(schema_headers, scrape_result_file, k=DEFAULT_TOP_K):
     """
     Given a list of scraped files, determine each's similarity relative to schema
     headers. Per-CSV score calculated by finding avg similarity across schema headers.
+    Headers are fetched and scored concurrently and only the top `k` files are kept
+    (see utils/dataset_ranker.py).
 
     Parameters:
     - schema_headers (dict): Contains the following keys:
@@ -58,11 +21,12 @@ def get_best_dataset(schema_headers, scrape_result_file):
         - non_default_pk (list): All column headers that are't generated by schema creator
     - scrape_result_file (str): File containing newline-separated URLs,
         each enabling CSV file download
+    - k (int): Number of best matches to return metrics for
 
     Returns:
     - best_url (str): URL of the best match CSV file
     - best_score (float): similarity score between 0-1 of the best match file
-    - all_metrics (dict): Contains the following:
+    - all_metrics (dict): Contains the following for the top `k` files, best first:
         - file URL (string): URL of CSV file we're providing information for.
             - score (float): Similarity score across all column headers for this given file
             - column_mapping (dict): Has the following structure:
@@ -72,26 +36,67 @@ def get_best_dataset(schema_headers, scrape_result_file):
                         between this column name and the 'schema_header_name'
     """
 
-    embedding_space = get_glove_embedding_space()
-
-    all_metrics = {}
-    best_url, best_score = None, -float('inf')
-
-    for url, csv_headers in get_headers(scrape_result_file):
-        print(f"\nprocessing {url}")
-        csv_matches = get_csv_matches(schema_headers['non_default_pk'], csv_headers, embedding_space)
-        score = sum([similarity for phrase, similarity in csv_matches.values()]) / len(csv_matches)
+    with open(scrape_result_file, 'r', encoding='utf-8-sig') as f:
+        urls = [scraped_url.strip() for scraped_url in f if scraped_url.strip()]
 
-        if score > best_score:
-            best_url, best_score = url, score
+    ranking = get_dataset_ranker().rank(schema_headers['non_default_pk'], urls, k)
 
-        all_metrics[url] = {
+    all_metrics = {
+        url: {
             "score": score,
             "column_mapping": csv_matches
         }
+        for url, score, csv_matches in ranking
+    }
 
+    if len(ranking) == 0:
+        return None, -float('inf'), all_metrics
+    best_url, best_score, _ = ranking[0]
     return best_url, best_score, all_metrics
 
+def stream_csv_rows(url, timeout=30):
+    """
+    Yield the rows of the (possibly compressed) CSV file at `url` as it downloads,
+    through the download cache. The connection is closed as soon as the generator
+    is, so reading the first rows of a multi-GB file only downloads its first blocks
+
+    Parameters:
+    - url (str): URL enabling CSV file download
+    - timeout (int): Seconds to wait for the server to respond or send more data
+
+    Yields:
+    - row (list): the values of the next CSV row, starting with the headers
+    """
+
+    with open_url(url, timeout=timeout) as stream:
+        raw = io.BufferedReader(stream)
+
+        compression = detect_compression(url, raw.peek(8)[:8])
+        if compression == 'zip':
+            raw = io.BytesIO(raw.read())  # the archive's directory is at its end
+
+        text = io.TextIOWrapper(open_binary(raw, compression), encoding='utf-8-sig', errors='replace', newline='')
+        yield from csv.reader(text)
+
+def read_mapped_rows(url, schema_headers, column_mapping, max_rows):
+    """
+    Up to `max_rows` rows of the CSV file at `url` as {schema header: value} dicts,
+    using the columns `column_mapping` (see create_er_csv) matches to the schema's
+    non-default PKs. Returns None if the file is empty.
+    """
+
+    with closing(stream_csv_rows(url)) as rows:
+        rows = filter(None, rows)  # skip blank lines
+        file_headers = next(rows, None)
+        if file_headers is None:
+            return None
+
+        # index of the CSV column matched to each schema column header, looked up once
+        col_ixs = {schema_col: file_headers.index(column_mapping[schema_col][0]) for schema_col in schema_headers['non_default_pk']}
+
+        # stops downloading after max_rows
+        return [{schema_col: row[ix] for schema_col, ix in col_ixs.items()} for row in islice(rows, max_rows)]
+
 def create_er_csv(output_dir, schema_headers, best_url, column_mapping, max_rows=50):
     """
     Given the schema's column headers, the file containing the best match, and a mapping
@@ -114,23 +119,19 @@ def create_er_csv(output_dir, schema_headers, best_url, column_mapping, max_rows
 
     output_filename = f"schema_{time.time()}.csv"
 
-    res = requests.get(best_url.strip())
-    if res.status_code != 200:
-        print(f"unable to get best file url {best_url}")
-
-    content = res.text
-    csv_data = list(csv.reader(content.splitlines()))
-    file_headers = csv_data[0]
-
-    # get the value in the CSV row corresponding to schema column header
-    get_val = lambda row, schema_col: row[file_headers.index(column_mapping[schema_col][0])]
-
-    er_rows = []
     print("column mapping:", column_mapping)
-    end_ix = min(len(csv_data), max_rows+1)
-    for row in csv_data[1:end_ix]: # add non-default PKs
-        er_row = {schema_col: get_val(row, schema_col) for schema_col in schema_headers['non_default_pk']}
-        er_rows.append(er_row)
+    try:
+        try:
+            er_rows = read_mapped_rows(best_url.strip(), schema_headers, column_mapping, max_rows)
+        except SourceChangedError:
+            # the stale cached copy was dropped, so this downloads the new file from scratch
+            er_rows = read_mapped_rows(best_url.strip(), schema_headers, column_mapping, max_rows)
+    except OSError as e:  # requests' errors included
+        print(f"unable to get best file url {best_url}:\n\t{e}")
+        return
+    if er_rows is None:
+        print(f"unable to get data at {best_url}")
+        return
 
     if len(schema_headers['default_pk']) != 0:
         pk = schema_headers['default_pk'][0] # add default PK
@@ -163,7 +164,10 @@ def generate_smart_data(output_dir, schema_headers, scraped_url_file):
     """
 
     best_url, best_score, all_metrics = get_best_dataset(schema_headers, scraped_url_file)
-    ranked_urls = sorted(all_metrics.keys(), key=lambda url: -all_metrics[url]['score'])
+    if best_url is None:
+        print("none of the scraped files could be read")
+        return
+    ranked_urls = list(all_metrics.keys()) # already best first
 
     print()
     print(f"best url match: {best_url} (score: {best_score})")
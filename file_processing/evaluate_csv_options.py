@@ -1,26 +1,34 @@
-import requests
-import csv
+import os
+import sys
+from contextlib import closing
 
-from utils.glove_col_similarity import *
+# the file_processing and table_joins packages are imported from the repository root
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root_directory not in sys.path:
+    sys.path.append(root_directory)
+
+from file_processing.create_er_csv import stream_csv_rows
+from file_processing.utils.glove_col_similarity import *
 
 def get_headers(scrape_result_file):
     """
-    Given a list of CSVs from scraping, extract and yield headers from each file
+    Given a list of CSVs from scraping, extract and yield headers from each file.
+    Files are read through the download cache, and only as far as their header row.
     """
     with open(scrape_result_file, 'r', encoding='utf-8-sig') as f:
         for line in f:
             url = line.strip()
             csv_filename = url.split("/")[-1]
-            res = requests.get(url)
+            try:
+                with closing(stream_csv_rows(url)) as rows:
+                    headers = next(rows, None)
+            except OSError:  # requests' errors included
+                headers = None
 
-            if res.status_code != 200:
+            if headers is None:
                 print(f"unable to get file {csv_filename}")
                 continue
 
-            content = res.text
-            csv_data = list(csv.reader(content.splitlines()))
-            headers = csv_data[0]
-
             print(f"headers for file {csv_filename}: {headers}")
             yield csv_filename, headers
 
@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from file_processing.utils.glove_col_similarity import get_csv_matches, get_glove_embedding_space
+
+MAX_SCORE = 1.0  # scores average cosine similarities, so no file scores higher
+DEFAULT_TOP_K = 10
+DEFAULT_WORKERS = 4
+
+
+def score_matches(csv_matches):
+    """
+    Average similarity of each schema header's best match (0 for headers with none)
+    """
+
+    if len(csv_matches) == 0:
+        return 0.0
+    return float(sum(match[1] if match is not None else 0.0 for match in csv_matches.values()) / len(csv_matches))
+
+
+class DatasetRanker:
+    """
+    Ranks scraped csvs by how well their headers match a schema's, keeping only the
+    best `k` in a heap.
+
+    Headers are probed concurrently (see HeaderProber) and each file is scored on a
+    pool of `workers` threads as soon as its headers arrive, so fetching and scoring
+    overlap. Scores are remembered per (url, schema headers). Since no file can score
+    above MAX_SCORE, ranking stops without probing the remaining files once the k-th
+    best score reaches it; remembered scores are ranked first, so a repeated ranking
+    may not probe anything. The GloVe embedding space is loaded once, by the first
+    scoring worker, and reused for every ranking.
+
+    Keyword arguments configure the HeaderProber.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, embedding_space=None, **prober_kwargs):
+        self.workers = workers
+        self.embedding_space = embedding_space
+        self.prober_kwargs = prober_kwargs
+        self.probed = 0
+        self.stopped_early = 0
+
+        self._scores = {}  # {(url, schema headers): (score, column mapping)}
+        self._lock = threading.Lock()
+
+    def _get_embedding_space(self):
+        with self._lock:
+            if self.embedding_space is None:
+                self.embedding_space = get_glove_embedding_space()
+            return self.embedding_space
+
+    def score(self, schema_headers, csv_headers):
+        """
+        (score, column mapping) of a file with `csv_headers` against `schema_headers`
+        """
+
+        csv_matches = get_csv_matches(schema_headers, csv_headers, self._get_embedding_space())
+        return score_matches(csv_matches), csv_matches
+
+    def rank(self, schema_headers, urls, k=DEFAULT_TOP_K):
+        """
+        The `k` csvs at `urls` whose headers best match `schema_headers`, best first,
+        as [(url, score, column mapping), ...]. Ties go to the earlier URL (among the
+        files scored before ranking stopped).
+        """
+
+        return asyncio.run(self._rank(list(schema_headers), list(urls), k))
+
+    async def _rank(self, schema_headers, urls, k):
+        schema_key = tuple(schema_headers)
+        heap = []  # (score, -index, url, column mapping), worst of the k best at the top
+
+        def push(index, url, result):
+            item = (result[0], -index, url, result[1])
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        def kth_score():
+            return heap[0][0] if len(heap) == k else -float('inf')
+
+        pending = []
+        for index, url in enumerate(urls):
+            result = self._scores.get((url, schema_key))
+            if result is not None:
+                push(index, url, result)
+            else:
+                pending.append((index, url))
+
+        if pending and kth_score() >= MAX_SCORE:
+            self.stopped_early += 1
+            pending = []
+
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(self.workers) as pool:
+            from file_processing.utils.http_prober import HeaderProber  # imports httpx
+
+            async with HeaderProber(**self.prober_kwargs) as prober:
+                async def probe_and_score(index, url):
+                    try:
+                        csv_headers = await prober.probe(url)
+                    except Exception as e:
+                        return index, url, e
+                    self.probed += 1
+                    if len(csv_headers) == 0:
+                        return index, url, None
+                    return index, url, await loop.run_in_executor(pool, self.score, schema_headers, csv_headers)
+
+                tasks = [asyncio.ensure_future(probe_and_score(index, url)) for index, url in pending]
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        index, url, result = await next_done
+                        if isinstance(result, Exception):
+                            print(f"encountered error when getting from {url}:\n\t{result!r}")
+                            continue
+                        if result is None:
+                            print(f"unable to get data at {url}")
+                            continue
+
+                        print(f"\nprocessing {url}")
+                        self._scores[(url, schema_key)] = result
+                        push(index, url, result)
+                        if kth_score() >= MAX_SCORE and not all(task.done() for task in tasks):
+                            self.stopped_early += 1
+                            break  # nothing left can beat the k best
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+        ranked = sorted(heap, reverse=True)
+        return [(url, score, column_mapping) for score, _, url, column_mapping in ranked]
+
+
+_ranker = None
+_ranker_lock = threading.Lock()
+
+
+def get_dataset_ranker():
+    """
+    Process-wide ranker, so repeated rankings share its warm embedding space and
+    remembered scores
+    """
+
+    global _ranker
+    with _ranker_lock:
+        if _ranker is None:
+            _ranker = DatasetRanker()
+        return _ranker
@@ -0,0 +1,530 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from table_joins.table_metadata import get_cache_dir, parse_bytes
+
+DOWNLOAD_CACHE_ENV = "SMART_GATHER_DOWNLOAD_CACHE"  # set to 0 to always download
+DOWNLOAD_CACHE_SIZE_ENV = "SMART_GATHER_DOWNLOAD_CACHE_SIZE"  # e.g. "2G"
+DOWNLOAD_MAX_AGE_ENV = "SMART_GATHER_DOWNLOAD_MAX_AGE"  # seconds a download is used before it's revalidated
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_MAX_AGE = 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+
+class SourceChangedError(OSError):
+    """
+    The file at a URL changed while a stream of it was being read. Its cached copy
+    has been dropped, so opening the URL again downloads the new file from scratch.
+    """
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def get_validators(headers):
+    """
+    ETag and Last-Modified of a response (either may be None)
+    """
+
+    return {'etag': headers.get('etag'), 'last_modified': headers.get('last-modified')}
+
+
+class DownloadCache:
+    """
+    On-disk store of downloaded resources, keyed by URL. Contents are stored once per
+    sha256 (so mirrors of the same file share it), each URL's entry records the
+    response's ETag/Last-Modified, and downloads older than `max_age` seconds are
+    revalidated with a conditional GET rather than downloaded again. Downloads cut
+    short (e.g. a header probe or the first rows of a file) are kept as partials that
+    later reads resume with a Range request. Once the store grows past `max_bytes`
+    the least recently used contents are evicted.
+
+    Network reads go through open() (a stream, for synchronous code) or, for async
+    clients, cached()/put()/put_prefix() around the caller's own requests.
+
+    Fields:
+        cache_dir: directory the store is kept in
+        max_bytes: size the store is trimmed to (None means unlimited)
+        max_age: seconds a download is used without revalidating (None means forever)
+        hits, revalidated, misses, resumed, evictions: counters since the cache was created
+        bytes_downloaded: bytes read from the network through open()
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir or get_cache_dir('downloads')
+        self.max_bytes = parse_bytes(max_bytes)
+        self.max_age = max_age
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.resumed = 0
+        self.evictions = 0
+        self.bytes_downloaded = 0
+
+        self._used_bytes = None  # computed on the first write
+        self._lock = threading.RLock()
+        self._session = None
+
+    def _entry_path(self, url):
+        key = url_key(url)
+        return os.path.join(self.cache_dir, 'entries', key[:2], key + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def _partial_path(self, url):
+        return os.path.join(self.cache_dir, 'partial', url_key(url))
+
+    def entry(self, url):
+        """
+        What's stored for `url`: {"url", "complete", "size", "etag", "last_modified",
+        "fetched" (time it was last downloaded or revalidated), "sha256" (complete
+        entries)}, or None
+        """
+
+        with self._lock:
+            try:
+                with open(self._entry_path(url), 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+
+            path = self.path(entry)
+            if not os.path.exists(path):  # evicted
+                self._remove(self._entry_path(url), accounted=False)
+                return None
+            if not entry['complete']:
+                entry['size'] = os.path.getsize(path)
+            return entry
+
+    def path(self, entry):
+        """
+        File holding the (complete or partial) contents of `entry`
+        """
+
+        if entry['complete']:
+            return self._object_path(entry['sha256'])
+        return self._partial_path(entry['url'])
+
+    def is_fresh(self, entry):
+        return self.max_age is None or time.time() - entry['fetched'] <= self.max_age
+
+    def _write_entry(self, url, **fields):
+        entry = dict(url=url, fetched=time.time(), **fields)
+        path = self._entry_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        return entry
+
+    def cached(self, url, n=None):
+        """
+        The first `n` bytes (all if None) of `url` if the cache has them and they're
+        fresh, as (data, complete) where `complete` says whether `data` runs to the
+        end of the file. Otherwise None.
+        """
+
+        with self._lock:
+            entry = self.entry(url)
+            if entry is None or not self.is_fresh(entry) or (not entry['complete'] and (n is None or entry['size'] < n)):
+                self.misses += 1
+                return None
+            path = self.path(entry)
+            with open(path, 'rb') as f:
+                data = f.read() if n is None else f.read(n)
+            os.utime(path)  # mtime orders contents for eviction
+            self.hits += 1
+            return data, entry['complete'] and (n is None or entry['size'] <= n)
+
+    def conditional_headers(self, url):
+        """
+        Headers making a GET of `url` return 304 Not Modified if the complete copy
+        in the cache is still current
+        """
+
+        entry = self.entry(url)
+        headers = {}
+        if entry is not None and entry['complete']:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def mark_revalidated(self, url):
+        """
+        Note that the server confirmed (304) the cached copy of `url` is current
+        """
+
+        with self._lock:
+            entry = self.entry(url)
+            if entry is not None:
+                entry.pop('url')
+                entry.pop('fetched')
+                self._write_entry(url, **entry)
+                os.utime(self.path(entry))
+                self.revalidated += 1
+
+    def put(self, url, data, headers):
+        """
+        Store `data`, the full contents of `url`, from a response with `headers`
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._scan()
+            path = self._object_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._used_bytes += len(data)
+            self._remove(self._partial_path(url))
+            entry = self._write_entry(url, complete=True, sha256=digest, size=len(data), **get_validators(headers))
+            self._enforce_size()
+            return entry
+
+    def put_prefix(self, url, data, headers):
+        """
+        Store `data`, the first bytes of `url`, from a response with `headers`. Only
+        kept if the response can be resumed (it has an ETag or Last-Modified).
+        """
+
+        validators = get_validators(headers)
+        if not (validators['etag'] or validators['last_modified']):
+            return None
+        with self._lock:
+            entry = self.entry(url)
+            if entry is not None and (entry['complete'] or entry['size'] >= len(data)):
+                return entry
+            self._scan()
+            path = self._partial_path(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._remove(path)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._used_bytes += len(data)
+            entry = self._write_entry(url, complete=False, size=len(data), **validators)
+            self._enforce_size()
+            return entry
+
+    def _start_partial(self, url, validators, resume):
+        """
+        Open the partial download of `url` to append to (emptied unless `resume`)
+        """
+
+        with self._lock:
+            path = self._partial_path(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not resume:
+                self._scan()
+                self._remove(path)
+            self._write_entry(url, complete=False, size=0, **validators)
+            return open(path, 'ab')
+
+    def _finish_partial(self, url):
+        """
+        Move the completed download of `url` into the content store
+        """
+
+        with self._lock:
+            entry = self.entry(url)
+            if entry is None or entry['complete']:
+                return entry
+            path = self._partial_path(url)
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(block)
+            digest = digest.hexdigest()
+
+            object_path = self._object_path(digest)
+            if os.path.exists(object_path):
+                self._remove(path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(path, object_path)
+            return self._write_entry(url, complete=True, sha256=digest, size=entry['size'], etag=entry['etag'], last_modified=entry['last_modified'])
+
+    def _discard(self, url):
+        with self._lock:
+            self._remove(self._partial_path(url))
+            self._remove(self._entry_path(url), accounted=False)
+
+    def _get(self, url, headers, timeout):
+        if self._session is None:
+            import requests  # only needed once something is downloaded
+            self._session = requests.Session()
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})  # store the bytes as served
+        return self._session.get(url, headers=headers, stream=True, timeout=timeout)
+
+    def open(self, url, timeout=30):
+        """
+        Binary stream of the contents of `url`, read from the cache as far as it has
+        them and from the network after that (storing what's downloaded)
+        """
+
+        return CachedDownload(self, url, timeout)
+
+    def _files(self):
+        for subdir in ('objects', 'partial'):
+            for root, _, files in os.walk(os.path.join(self.cache_dir, subdir)):
+                for name in files:
+                    if not name.endswith('.tmp'):
+                        yield os.path.join(root, name)
+
+    def _scan(self):
+        if self._used_bytes is None:
+            self._used_bytes = sum(os.path.getsize(path) for path in self._files())
+
+    def _remove(self, path, accounted=True):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        if accounted and self._used_bytes is not None:
+            self._used_bytes -= size
+
+    def _grew(self, nbytes):
+        with self._lock:
+            self._scan()
+            self._used_bytes += nbytes
+
+    def _enforce_size(self):
+        with self._lock:
+            if self.max_bytes is None or self._used_bytes is None or self._used_bytes <= self.max_bytes:
+                return
+            for path in sorted(self._files(), key=os.path.getmtime):  # least recently used first
+                if self._used_bytes <= self.max_bytes:
+                    break
+                self._remove(path)  # entries pointing at it are dropped when next looked up
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    self._remove(os.path.join(root, name), accounted=False)
+            self._used_bytes = 0
+
+    def stats(self):
+        """
+        Hit metrics and size of the cache
+        """
+
+        with self._lock:
+            self._scan()
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.revalidated) / lookups if lookups else 0.0,
+                'resumed': self.resumed,
+                'evictions': self.evictions,
+                'bytes_downloaded': self.bytes_downloaded,
+                'bytes': self._used_bytes,
+            }
+
+
+class CachedDownload(io.RawIOBase):
+    """
+    Readable stream of a URL's contents through a DownloadCache (see
+    DownloadCache.open). A fresh complete copy is read from disk; a stale one is
+    revalidated first. A partial copy is read from disk and then resumed from where
+    it ends with a Range request, only if the reader gets that far. Whatever comes
+    from the network is appended to the partial copy, which becomes a complete copy
+    once the end of the file is reached, and is kept for next time if the stream is
+    closed early.
+    """
+
+    def __init__(self, cache, url, timeout=30):
+        self.cache = cache
+        self.url = url
+        self.timeout = timeout
+
+        self._source = None  # cached file being read
+        self._response = None  # download being read after it
+        self._sink = None  # partial copy the download is appended to
+        self._resume_from = None  # end of the partial copy, if the rest hasn't been requested yet
+        self._validators = {}
+        self._position = 0
+
+        entry = cache.entry(url)
+        if entry is not None and entry['complete']:
+            if cache.is_fresh(entry):
+                cache.hits += 1
+                self._open_cached(entry)
+                return
+            response = cache._get(url, cache.conditional_headers(url), timeout)
+            if response.status_code == 304:
+                response.close()
+                cache.mark_revalidated(url)
+                self._open_cached(entry)
+                return
+            self._start(response)
+        elif entry is not None:
+            self._validators = {'etag': entry['etag'], 'last_modified': entry['last_modified']}
+            self._open_cached(entry)
+            self._resume_from = entry['size']
+            if cache.is_fresh(entry):
+                cache.hits += 1
+            else:
+                self._resume()  # check the copy is still current before reading it
+        else:
+            self._start(cache._get(url, {}, timeout))
+
+    def _open_cached(self, entry):
+        path = self.cache.path(entry)
+        os.utime(path)
+        self._source = open(path, 'rb')
+
+    def _start(self, response):
+        """
+        Download the whole file from `response`
+        """
+
+        response.raise_for_status()
+        self.cache.misses += 1
+        self._response = response
+        self._validators = get_validators(response.headers)
+        self._sink = self.cache._start_partial(self.url, self._validators, resume=False)
+
+    def _resume(self):
+        """
+        Request the rest of the partial copy, unless it turns out to be complete or stale
+        """
+
+        offset, self._resume_from = self._resume_from, None
+        if_range = self._validators['etag'] or self._validators['last_modified']
+        response = self.cache._get(self.url, {'Range': f'bytes={offset}-', 'If-Range': if_range}, self.timeout)
+
+        if response.status_code == 416:  # the partial copy was the whole file
+            response.close()
+            self.cache._finish_partial(self.url)
+        elif response.status_code == 206:
+            self.cache.resumed += 1
+            self._response = response
+            self._sink = self.cache._start_partial(self.url, self._validators, resume=True)
+        else:
+            response.raise_for_status()
+            if self._position > 0:
+                response.close()
+                self.cache._discard(self.url)
+                raise SourceChangedError(f"{self.url} changed while it was being read")
+            # the file changed before any of the old copy was read: download the new one
+            if self._source is not None:
+                self._source.close()
+                self._source = None
+            self._start(response)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._source is not None:
+            n = self._source.readinto(b)
+            if n:
+                self._position += n
+                return n
+            self._source.close()
+            self._source = None
+
+        if self._resume_from is not None:
+            self._resume()
+            if self._source is not None:  # changed file, downloaded from the start
+                return self.readinto(b)
+
+        if self._response is None:
+            return 0
+
+        data = self._response.raw.read(len(b))
+        if not data:
+            self._finish()
+            return 0
+        self._sink.write(data)
+        self.cache.bytes_downloaded += len(data)
+        self.cache._grew(len(data))
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def _finish(self):
+        self._close_download(complete=True)
+
+    def _close_download(self, complete=False):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+            if complete:
+                self.cache._finish_partial(self.url)
+            elif not (self._validators.get('etag') or self._validators.get('last_modified')):
+                self.cache._discard(self.url)  # a partial copy can't be resumed safely
+            self.cache._enforce_size()
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._response is not None:  # closed before the end: keep what was downloaded
+            self._close_download()
+        super().close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_download_cache():
+    """
+    Process-wide download cache shared by the scraper, header prober and
+    create_er_csv, configured from the SMART_GATHER_DOWNLOAD_CACHE,
+    SMART_GATHER_DOWNLOAD_CACHE_SIZE and SMART_GATHER_DOWNLOAD_MAX_AGE environment
+    variables. Returns None if caching is disabled.
+    """
+
+    global _cache
+    if os.environ.get(DOWNLOAD_CACHE_ENV, '1') == '0':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            max_age = os.environ.get(DOWNLOAD_MAX_AGE_ENV)
+            _cache = DownloadCache(
+                max_bytes=os.environ.get(DOWNLOAD_CACHE_SIZE_ENV) or DEFAULT_MAX_BYTES,
+                max_age=float(max_age) if max_age else DEFAULT_MAX_AGE,
+            )
+        return _cache
+
+
+def open_url(url, timeout=30):
+    """
+    Binary stream of the contents of `url`, through the download cache if enabled
+    """
+
+    cache = get_download_cache()
+    if cache is not None:
+        return cache.open(url, timeout)
+
+    import requests
+
+    response = requests.get(url, stream=True, timeout=timeout)
+    response.raise_for_status()
+    response.raw.decode_content = True  # undo any Content-Encoding
+    response.raw.auto_close = False  # so reading past the end gives b'' rather than an error
+    return response.raw
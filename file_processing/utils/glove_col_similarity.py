@@ -1,6 +1,6 @@
 import numpy as np
 from collections import defaultdict
-from scipy.spatial.distance import cosine
+from functools import lru_cache
 import re
 
 import sys
@@ -12,9 +12,20 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 # Get the parent directory
 parent_directory = os.path.dirname(current_directory)
 
+def cosine(u, v):
+    """
+    Cosine distance between two vectors. scipy is imported on first use since it's
+    slow to import and only needed once headers are compared.
+    """
+
+    from scipy.spatial.distance import cosine as cosine_distance
+    return cosine_distance(u, v)
+
+@lru_cache(maxsize=None)
 def get_glove_embedding_space():
     """
-    Load a small set of GloVe word embeddings (https://nlp.stanford.edu/projects/glove/)
+    Load a small set of GloVe word embeddings (https://nlp.stanford.edu/projects/glove/).
+    Loaded once per process; later calls share the same (read-only) space.
     """
     filename = os.path.join(parent_directory, 'glove.6B.50d.txt')
     print("Reading embedding file...")
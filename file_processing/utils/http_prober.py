@@ -0,0 +1,177 @@
+import asyncio
+import csv
+import io
+import zipfile
+
+import httpx
+
+from file_processing.utils.download_cache import get_download_cache
+from table_joins.table_metadata import PEEK_BYTES, detect_compression, peek_prefix
+
+PROBE_BYTES = 16 * 1024  # first range requested, enough for most header rows
+MAX_PROBE_BYTES = 1024 ** 2  # give up on header rows longer than this
+MAX_ZIP_BYTES = 64 * 1024 ** 2  # zips are read whole (their directory is at the end)
+DEFAULT_CONCURRENCY = 100
+
+
+def parse_header(data, url=''):
+    """
+    Parse the header row out of the first bytes of the (possibly compressed) csv at
+    `url`.
+
+    Returns:
+    - headers (list): the column headers, or None if `data` ends before the header row does
+    """
+
+    compression = detect_compression(url, data[:8])
+    for n in (PEEK_BYTES, MAX_PROBE_BYTES):  # only inflate past the first block for long headers
+        head = peek_prefix(data, compression, n)
+        if b'\n' in head:
+            return next(csv.reader(io.StringIO(head.decode('utf-8-sig', errors='replace'))), [])
+        if len(head) < n:
+            break
+    return None
+
+
+def _has_header(data, url):
+    try:
+        return parse_header(data, url) is not None
+    except zipfile.BadZipFile:
+        return False
+
+
+class HeaderProber:
+    """
+    Reads the header rows of remote csvs without downloading them. Each probe asks
+    for the first `probe_bytes` with a Range request, growing the range if the header
+    row is longer; servers that ignore Range are read as a stream that's closed once
+    the header row has arrived. Probes run concurrently (up to `max_concurrency` at
+    once) over one pooled keep-alive client, and each gets `timeout` seconds in total.
+
+    Bytes already in the download cache (`cache`, or the process-wide one) aren't
+    fetched again, and what's fetched is stored there (as a partial download, unless
+    it's the whole file). Set `use_cache` to False to bypass it.
+
+    `client` (an httpx.AsyncClient) and `base_url` can be injected, e.g. to probe a
+    local test server; a client created here is closed with the prober.
+    """
+
+    def __init__(self, client=None, base_url=None, max_concurrency=DEFAULT_CONCURRENCY, timeout=5.0, probe_bytes=PROBE_BYTES, cache=None, use_cache=True):
+        self.cache = (cache or get_download_cache()) if use_cache else None
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.probe_bytes = probe_bytes
+        self.requests = 0
+
+        self._owns_client = client is None
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=base_url or '',
+                follow_redirects=True,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            )
+        self.client = client
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def _fetch(self, url, limit, stop_early=True):
+        """
+        Up to `limit` bytes from the start of `url`, and whether that's the whole file.
+        When the server ignores Range, the stream is closed as soon as the header row
+        is in (if `stop_early`).
+        """
+
+        if self.cache is not None:
+            cached = self.cache.cached(url, limit)
+            if cached is not None:
+                return cached
+
+        data, complete, headers = await self._download(url, limit, stop_early)
+        if self.cache is not None:
+            if complete:
+                self.cache.put(url, data, headers)
+            else:
+                self.cache.put_prefix(url, data, headers)
+        return data, complete
+
+    async def _download(self, url, limit, stop_early):
+        self.requests += 1
+        request_headers = {'Range': f'bytes=0-{limit - 1}', 'Accept-Encoding': 'identity'}
+        async with self.client.stream('GET', url, headers=request_headers) as response:
+            if response.status_code == 416:  # empty file
+                return b'', True, response.headers
+            response.raise_for_status()
+
+            data = b''
+            async for chunk in response.aiter_raw():
+                data += chunk
+                if len(data) >= limit:
+                    return data[:limit], False, response.headers
+                if stop_early and response.status_code == 200 and _has_header(data, url):
+                    return data, False, response.headers
+            return data, True, response.headers  # the file (or range) ended before `limit`
+
+    async def _probe(self, url):
+        limit = self.probe_bytes
+        whole = detect_compression(url) == 'zip'
+        while True:
+            data, complete = await self._fetch(url, MAX_ZIP_BYTES if whole else limit, stop_early=not whole)
+            try:
+                headers = parse_header(data, url)
+            except zipfile.BadZipFile:
+                if whole or complete:
+                    raise
+                whole = True  # a zip found by its magic bytes
+                continue
+            if headers is not None or complete:
+                return headers or []
+            if whole or limit >= MAX_PROBE_BYTES:
+                raise ValueError(f"no header row in the first {len(data)} bytes of {url}")
+            limit = min(limit * 4, MAX_PROBE_BYTES)
+
+    async def probe(self, url):
+        """
+        Header row of the csv at `url` ([] for an empty file). Raises on HTTP errors
+        and timeouts.
+        """
+
+        if self._semaphore is None:  # bound to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.wait_for(self._probe(url), self.timeout)
+
+    async def probe_all(self, urls):
+        """
+        Header rows of the csvs at `urls`, in order. Failed probes give their
+        exception instead of a header row.
+        """
+
+        return await asyncio.gather(*[self.probe(url) for url in urls], return_exceptions=True)
+
+
+def probe_headers(urls, **kwargs):
+    """
+    Probe `urls` concurrently from synchronous code. Keyword arguments configure the
+    HeaderProber.
+
+    Returns:
+    - results (list): per URL, its header row or the exception its probe raised
+    """
+
+    async def run():
+        async with HeaderProber(**kwargs) as prober:
+            return await prober.probe_all(urls)
+
+    if len(urls) == 0:
+        return []
+    return asyncio.run(run())
@@ -0,0 +1,83 @@
+import hashlib
+import os
+
+import numpy as np
+
+from table_metadata import get_cache_dir
+
+COLUMNAR_CACHE_ENV = "SMART_GATHER_COLUMNAR_CACHE"  # set to 0 to always parse the csv text
+
+
+def is_enabled():
+    if os.environ.get(COLUMNAR_CACHE_ENV, '1') == '0':
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _cache_path(meta, delimiter, engine):
+    # parsers name columns and infer dtypes differently, so each gets its own copy
+    key = hashlib.sha256(f"{meta.fingerprint}:{delimiter}:{meta.encoding}:{engine}".encode()).hexdigest()
+    return os.path.join(get_cache_dir('columnar'), key + '.arrow')
+
+
+def load(meta, delimiter, engine, usecols=None):
+    """
+    Memory-map the Arrow IPC copy of the csv described by `meta`, as parsed by
+    `engine`, reading only the columns selected by `usecols` (a list of names or a
+    callable, as for pd.read_csv). Returns None if there is no usable copy.
+    """
+
+    from pyarrow import feather, ipc
+
+    path = _cache_path(meta, delimiter, engine)
+    if not os.path.exists(path):
+        return None
+
+    with ipc.open_file(path) as reader:
+        schema = reader.schema
+    # pandas may have turned leading columns into the index (rows wider than the header)
+    index_columns = [col for col in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(col, str)]
+    names = [name for name in schema.names if name not in index_columns]
+    if usecols is None:
+        columns = names
+    elif callable(usecols):
+        columns = [name for name in names if usecols(name)]
+    else:
+        wanted = set(col.strip() for col in usecols)
+        if not wanted.issubset(names):
+            return None  # let pd.read_csv raise its usual error
+        columns = [name for name in names if name in wanted]
+
+    df = feather.read_table(path, columns=columns + index_columns, memory_map=True).to_pandas()
+
+    # Arrow nulls come back as None in object columns; the csv parser gives NaN
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].fillna(np.nan)
+    return df
+
+
+def store(meta, delimiter, engine, df):
+    """
+    Write a typed, uncompressed (so it can be memory-mapped) Arrow IPC copy of
+    `df`, the full parse by `engine` of the csv described by `meta`. Frames Arrow
+    can't type, e.g. object columns mixing numbers and strings, are not cached.
+    """
+
+    import pyarrow as pa
+    from pyarrow import feather
+
+    path = _cache_path(meta, delimiter, engine)
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError, TypeError):
+        return None
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+    return path
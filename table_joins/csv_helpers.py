@@ -1,11 +1,242 @@
-import csv
+import os
 import pandas as pd
 
-def read_csv(filepath, delimiter=None):
+import columnar_cache
+from table_metadata import get_table_metadata, open_table
+
+CSV_ENGINE_ENV = "SMART_GATHER_CSV_ENGINE"  # "c" (default) or "pyarrow"
+
+# pd.read_csv options the pyarrow engine doesn't support
+PYARROW_UNSUPPORTED = {'chunksize', 'iterator', 'nrows', 'low_memory', 'skipfooter', 'converters', 'memory_map', 'float_precision'}
+
+# compact dtypes to parse ER schema column types (er_types.Column.type names) into
+SCHEMA_TYPE_DTYPES = {'int': 'Int64', 'float': 'float32', 'str': 'category', 'bool': 'boolean'}
+# join columns must compare equal across files, which categoricals with different categories don't
+JOIN_TYPE_DTYPES = {'int': 'Int64', 'float': 'float64', 'str': 'string', 'bool': 'boolean'}
+
+_csv_engine = None
+
+def set_csv_engine(engine):
+	"""
+	Choose the parser used by read_csv: "c" (pandas' single-threaded parser) or
+	"pyarrow" (multithreaded, with Arrow-backed string columns). None restores
+	the $SMART_GATHER_CSV_ENGINE default.
+	"""
+	global _csv_engine
+	if engine not in (None, 'c', 'pyarrow'):
+		raise ValueError(f"unknown csv engine {engine}")
+	_csv_engine = engine
+
+def get_csv_engine():
+	return _csv_engine or os.environ.get(CSV_ENGINE_ENV, 'c')
+
+def get_read_dtypes(schema_types, files_to_matches, intersections=None):
+	"""
+	Derive per-file dtype maps for read_csv from the ER schema column types and the
+	planned column mapping, so matched columns are parsed straight into compact
+	types. Join partners of a typed column get the same (join-safe) dtype so the
+	join candidates' dtypes line up.
+
+	Args:
+		schema_types (dict): {schema_col: type name}, as written by create_json_schema
+		files_to_matches (dict): {file: [(file_col, schema_col), ...]}
+		intersections (dict): {(file_1, file_2): [(col_1, col_2, similarity), ...]}
+
+	Returns:
+		dict: {file: {file_col: dtype}}
+	"""
+	col_types = {}  # {(file, file_col): type name}
+	for file, matches in files_to_matches.items():
+		for file_col, schema_col in matches:
+			type_name = schema_types.get(schema_col)
+			if type_name in SCHEMA_TYPE_DTYPES:
+				col_types.setdefault((file, file_col), type_name)
+
+	dtypes = {}
+	for (file, file_col), type_name in col_types.items():
+		dtypes.setdefault(file, {})[file_col] = SCHEMA_TYPE_DTYPES[type_name]
+
+	for (file_1, file_2), join_cols in (intersections or {}).items():
+		if isinstance(join_cols, tuple):
+			join_cols = [join_cols]
+		for jc in join_cols:
+			type_name = col_types.get((file_1, jc[0])) or col_types.get((file_2, jc[1]))
+			if type_name is None:
+				continue
+			dtypes.setdefault(file_1, {})[jc[0]] = JOIN_TYPE_DTYPES[type_name]
+			dtypes.setdefault(file_2, {})[jc[1]] = JOIN_TYPE_DTYPES[type_name]
+
+	return dtypes
+
+def _apply_dtypes(df, dtype):
+	# convert column by column, leaving columns whose values don't fit the type as inferred
+	for col, col_dtype in dtype.items():
+		if col in df.columns and df[col].dtype != col_dtype:
+			try:
+				df[col] = df[col].astype(col_dtype)
+			except (TypeError, ValueError):
+				pass
+	return df
+
+class _ChunkReader:
+	"""
+	Iterates over the chunks of a pd.read_csv TextFileReader, trimming whitespace
+	from their headers and converting each chunk's columns with _apply_dtypes
+	"""
+	def __init__(self, reader, dtype=None, strip_headers=True):
+		self.reader = reader
+		self.dtype = dtype
+		self.strip_headers = strip_headers
+
+	def _prepare(self, chunk):
+		if self.strip_headers:
+			chunk.columns = [col.strip() for col in chunk.columns]
+		if self.dtype is not None:
+			chunk = _apply_dtypes(chunk, self.dtype)
+		return chunk
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return self._prepare(next(self.reader))
+
+	def get_chunk(self, size=None):
+		return self._prepare(self.reader.get_chunk(size))
+
+	def close(self):
+		self.reader.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def _select_columns(df, usecols):
+	if usecols is None:
+		return df
+	if callable(usecols):
+		return df[[col for col in df.columns if usecols(col)]]
+	wanted = set(col.strip() for col in usecols)
+	return df[[col for col in df.columns if col in wanted]]
+
+def _c_engine_names(names):
+	"""
+	Name columns the way the C parser does: "Unnamed: i" for empty headers and
+	".1", ".2", ... suffixes on duplicates
+	"""
+	result = []
+	for i, name in enumerate(names):
+		if name.strip() == '':
+			name = f"Unnamed: {i}"
+		candidate, n = name, 0
+		while candidate in result:
+			n += 1
+			candidate = f"{name}.{n}"
+		result.append(candidate)
+	return result
+
+def _arrow_strings(df):
+	for col in df.columns:
+		if df[col].dtype == object:
+			try:
+				df[col] = df[col].astype('string[pyarrow]')
+			except (ImportError, TypeError, ValueError):
+				pass
+	return df
+
+def _open(filepath, meta):
+	# tables defined by a header overlay are read through a stream with the header swapped in
+	if meta.overlay is None:
+		return filepath, meta.compression
+	return open_table(filepath), None
+
+def _parse(filepath, meta, delimiter, engine, **kwargs):
+	def parse(**kwargs):
+		source, compression = _open(filepath, meta)
+		return pd.read_csv(source, sep=delimiter, encoding=meta.encoding, compression=compression, **kwargs)
+
+	if engine == 'pyarrow' and len(delimiter) == 1 and not (set(kwargs) & PYARROW_UNSUPPORTED):
+		usecols = kwargs.pop('usecols', None)
+		if usecols is not None and not callable(usecols):
+			kwargs['usecols'] = usecols
+		try:
+			df = parse(engine='pyarrow', **kwargs)
+			df.columns = _c_engine_names(list(df.columns))
+			return _select_columns(df, usecols) if callable(usecols) else df
+		except (ImportError, ValueError):
+			# e.g. rows wider than the header or quoting pyarrow can't handle
+			kwargs.pop('usecols', None)
+			if usecols is not None:
+				kwargs['usecols'] = usecols
+
+	dtype = kwargs.pop('dtype', None)
+	if isinstance(dtype, dict):
+		if kwargs.get('chunksize') is not None or kwargs.get('iterator'):
+			# a value that doesn't parse would only raise mid-iteration, so read_csv
+			# converts each chunk instead
+			return parse(**kwargs)
+		try:
+			return parse(dtype=dtype, **kwargs)
+		except (TypeError, ValueError):
+			# some value doesn't parse as its schema type; infer, then convert what fits
+			return _apply_dtypes(parse(**kwargs), dtype)
+	elif dtype is not None:
+		kwargs['dtype'] = dtype
+
+	return parse(**kwargs)
+
+def read_csv(filepath, delimiter=None, strip_headers=True, engine=None, **kwargs):
+	"""
+	Read a csv into a DataFrame using the dialect and encoding cached in the
+	table metadata registry, so each file is only sniffed once. Extra keyword
+	arguments are passed on to pd.read_csv.
+
+	Plain reads (optionally with `usecols`) go through the columnar cache: the
+	first read writes a typed Arrow copy of the file, later reads memory-map it
+	and only load the requested columns.
+
+	`engine` (default from set_csv_engine) picks the parser; "pyarrow" falls back
+	to the C parser for options or dialects pyarrow can't handle.
+
+	A `dtype` dict (see get_read_dtypes) parses those columns straight into the
+	given types; columns whose values don't fit keep their inferred dtype. With
+	`chunksize` or `iterator`, each chunk is converted as it's read, so a column
+	keeps its inferred dtype only in the chunks where its values don't fit.
+	"""
+	meta = get_table_metadata(filepath)
 	if delimiter is None:
-		sniffer = csv.Sniffer()
-		with open(filepath, 'r', encoding='utf-8-sig') as f:
-			dialect = sniffer.sniff(f.read(1024))
-			delimiter = dialect.delimiter
-		f.close()
-	return pd.read_csv(filepath, sep=delimiter)
+		delimiter = meta.delimiter
+	if engine is None:
+		engine = get_csv_engine()
+
+	dtype = kwargs.get('dtype')
+	use_cache = strip_headers and set(kwargs) <= {'usecols', 'dtype'} and columnar_cache.is_enabled()
+	df = None
+	if use_cache:
+		df = columnar_cache.load(meta, delimiter, engine, kwargs.get('usecols'))
+		# typed parses aren't cached: the cache holds the untyped parse other readers expect
+		use_cache = use_cache and dtype is None
+		kwargs = dict(kwargs)
+		usecols = kwargs.pop('usecols', None) if use_cache else None
+
+	if df is None:
+		df = _parse(filepath, meta, delimiter, engine, **kwargs)
+
+		if isinstance(df, pd.io.parsers.TextFileReader):
+			df = _ChunkReader(df, dtype if isinstance(dtype, dict) else None, strip_headers)
+		elif strip_headers:
+			# trim whitespace from headers
+			df.columns = [col.strip() for col in df.columns]
+
+		if use_cache:
+			columnar_cache.store(meta, delimiter, engine, df)
+			df = _select_columns(df, usecols)
+
+	if isinstance(dtype, dict) and isinstance(df, pd.DataFrame):
+		# cached frames, and headers that only match once stripped
+		df = _apply_dtypes(df, dtype)
+	if engine == 'pyarrow' and isinstance(df, pd.DataFrame):
+		df = _arrow_strings(df)
+	return df
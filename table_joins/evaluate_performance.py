@@ -1,8 +1,9 @@
-import csv
 import pandas as pd
 import pickle
 import os
 
+from csv_helpers import read_csv
+
 class EvaluatePerformance:
     BASELINE, REGULAR, GPT_HEADER, GPT_JOIN, GPT_HEADER_GPT_JOIN = 'BASELINE', 'REGULAR', 'GPT HEADER', 'GPT JOIN', 'GPT HEADER GPT JOIN'
     CATEGORIES = [BASELINE, REGULAR, GPT_HEADER, GPT_JOIN, GPT_HEADER_GPT_JOIN]
@@ -25,14 +26,7 @@ class EvaluatePerformance:
 
 
     def _get_df(self, filename):
-        sniffer = csv.Sniffer()
-        
-        with open(filename, 'r', encoding='utf-8-sig') as f:
-            dialect = sniffer.sniff(f.read(1024))
-        f.close()
-        
-        df = pd.read_csv(filename, sep=dialect.delimiter)
-        df.columns = [col.strip() for col in df.columns]
+        df = read_csv(filename)
 
         for col in df.columns:
             df[col] = df[col].astype(str) # so can merge to count # rows in common
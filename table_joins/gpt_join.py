@@ -1,4 +1,4 @@
-import openai
+import json
 from dotenv import load_dotenv
 
 import sys
@@ -14,24 +14,56 @@ parent_directory = os.path.dirname(current_directory)
 sys.path.append(parent_directory)
 
 # Now you can import your module
-from manual_join import get_headers, get_matches
-from gpt_optimizations.gpt_column_headers import get_data_sample
+from manual_join import get_best_intersections, get_embedding_space, get_headers, get_matches
+from join_prefilter import JoinPrefilter
+from gpt_optimizations.prompt_builder import build_table_excerpt, count_tokens, record_prompt_tokens
+from llm_client import run_completions
 
 load_dotenv()
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
-client = openai.OpenAI(api_key = OPENAI_API_KEY)
+GPT_CONTEXT_TOKENS = 8192  # gpt-4
+BATCHED_RESPONSE_TOKENS = 2048
 
-def get_gpt_input(schema_headers, csv_headers, filename_1, filename_2):
+def get_join_candidates(csv_headers, filenames):
+    """
+    Header pairs of each pair of `filenames` similar enough to join on (see
+    manual_join.get_best_intersections), whatever their names:
+    {(file_1, file_2): [(col_1, col_2), ...]}
+    """
+    embedding_space = get_embedding_space()
+    return {
+        (file_1, file_2): [(c1, c2) for _, c1, c2 in get_best_intersections(csv_headers[file_1], csv_headers[file_2], embedding_space)]
+        for i, file_1 in enumerate(filenames) for file_2 in filenames[i+1:]
+    }
+
+def get_relevant_columns(file_name, csv_headers, files_to_matches, other_files, join_candidates=None):
+    """
+    Columns of `file_name` a join prompt must show: those matched to the schema,
+    those whose name (agnostic of spaces) also appears in one of `other_files` and
+    its candidate join keys with them in `join_candidates` (see get_join_candidates)
+    """
+    other_cols = set(col.replace(" ", "") for other in other_files for col in csv_headers[other])
+    relevant = [col for col, _ in files_to_matches.get(file_name, [])]
+    relevant += [col for col in csv_headers[file_name] if col != '' and col.replace(" ", "") in other_cols]
+    for (file_1, file_2), pairs in (join_candidates or {}).items():
+        if file_1 == file_name and file_2 in other_files:
+            relevant += [c1 for c1, _ in pairs]
+        elif file_2 == file_name and file_1 in other_files:
+            relevant += [c2 for _, c2 in pairs]
+    return list(dict.fromkeys(relevant))
+
+def get_gpt_input(schema_headers, csv_headers, filename_1, filename_2, files_to_matches=None, join_candidates=None):
     """
     Given a set of csv headers, return the set of headers that are common across all csv files
     """
     gpt_input = ""
-    for idx, (file_name, headers) in enumerate([(filename_1, csv_headers[filename_1]), (filename_2, csv_headers[filename_2])]):
-        headers = [header for header in headers if header != ''] # remove empty string headers
-        header, data = get_data_sample(file_name, random_sample=True)
-        # Get schema headers ", ".join(headers)
-        gpt_input += f"Schema {idx}:\n" + header + "\n\n"
+    for idx, (file_name, other) in enumerate([(filename_1, filename_2), (filename_2, filename_1)]):
+        # Get schema headers and sample rows compacted to the prompt budget
+        keep_columns = None
+        if files_to_matches is not None:
+            keep_columns = get_relevant_columns(file_name, csv_headers, files_to_matches, [other], join_candidates)
+        header, data, _ = build_table_excerpt(file_name, keep_columns=keep_columns)
+        gpt_input += f"Schema {idx}:\n" + header + "\n"
         # Get sample rows from file name
         gpt_input += f"Sample rows from Schema {idx}:\n"
         gpt_input += data + "\n\n"
@@ -39,76 +71,31 @@ def get_gpt_input(schema_headers, csv_headers, filename_1, filename_2):
 
     return gpt_input
 
-def find_header_intersection_gpt(schema_headers, csv_headers, files_to_matches, print_results=False):
+def match_column(name, cols):
     """
-    Given the set of files + column headers that we need to join across, find the column most similar
-    across each pair that will be the target of the join
-
-    Return format: dict mapping filenames part of the intersection to cols that most resemble each other
-    (file1, file2) -> (best col name match in file1, best col name match in file2)
+    Column of `cols` GPT meant by `name` (agnostic of spaces), else `name` itself
     """
-    filenames = [fn for fn in files_to_matches.keys()]
-    intersections = []
+    for col in cols:
+        if col.replace(" ", "") == name.replace(" ", ""):
+            return col
+    return name
 
-    for i in range(len(filenames)):
-        cols1 = csv_headers[filenames[i]]
-        for j in range(i+1, len(filenames)):
-            cols2 = csv_headers[filenames[j]]
-
-            gpt_input = get_gpt_input(schema_headers, csv_headers, filenames[i], filenames[j])
-            prompt = "Match each column from Schema 0 to a column from Schema 1 only if they represent the " + \
-                    "same data. Output the answer only as a list of length-two tuples that contain the corresponding " + \
-                    "columns from Schema 0 and Schema 1, with no other output.\n"
-            # prompt = "Match each column from each schema to a column from each other schema only if they represent the " + \
-            #         "same data. Output the answer only as a list of length-three tuples that contain the corresponding " + \
-            #         "columns from Schema 0 and Schema 1 as the first two values, and a comma-separated string representing " + \
-            #         "which two schemas the tuple represents, with no other output. For example, a join on Schema 0 and Schema 1 " + \
-            #         "whould have tuples of the form ('column from schema 0', 'column from schema 1', '0,1').\n\n"
-            if print_results:
-                print("gpt input:", gpt_input)
-                print()
-                print("gpt prompt:", prompt)
-                print()
-
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                {"role": "system",
-                "content": gpt_input + prompt}
-                ],
-                temperature=0,
-                max_tokens=1024
-            )
-            if print_results:
-                print("gpt output:", response.choices[0].message.content)
-
-            str_response = response.choices[0].message.content
-
-            # Convert string into list of tuples
-            str_response = str_response.replace("[", "").replace("]", "").replace("(", "").replace(")", "").replace("'", "").replace('"', "").replace("\n", "")
-            str_response = str_response.split(", ")
-            lis_response = []
-            for s in range(0, len(str_response)-1, len(files_to_matches)):
-                schema_0_col = str_response[s]
-                schema_1_col = str_response[s+1]
-                # Find col in schema 0 and schema 1 that matches the col name (agnostic of spaces)
-                for col in cols1:
-                    if col.replace(" ", "") == schema_0_col.replace(" ", ""):
-                        schema_0_col = col
-                        break
-                for col in cols2:
-                    if col.replace(" ", "") == schema_1_col.replace(" ", ""):
-                        schema_1_col = col
-                        break
-                lis_response.append((schema_0_col, schema_1_col))
-            if print_results:
-                print("response:", lis_response)
-
-            best_intersections = [(1, c1, c2) for c1, c2 in lis_response]
-            new_intersections = [(sim, filenames[i], filenames[j], col1, col2) for sim, col1, col2 in best_intersections]
-
-            intersections.extend(new_intersections)
+def prefilter_pairs(csv_headers, filenames, prefilter, print_results=False):
+    """
+    Intersections the prefilter accepts without GPT and the (i, j) pairs of `filenames`
+    left for GPT (every pair if `prefilter` is off)
+    """
+    if not prefilter:
+        return [], [(i, j) for i in range(len(filenames)) for j in range(i+1, len(filenames))]
+    if not isinstance(prefilter, JoinPrefilter):
+        prefilter = JoinPrefilter(get_embedding_space(), verbose=print_results)
+    return prefilter.split_pairs(csv_headers, filenames)
 
+def select_intersections(intersections, files_to_matches):
+    """
+    Given (similarity, file1, file2, col1, col2) matches, keep the file pairs needed to
+    connect every file, keyed by the file pair
+    """
     intersections.sort(reverse=True)
 
     # move intersections from list format sorted by similarity to keyed by the file pair
@@ -135,10 +122,202 @@ def find_header_intersection_gpt(schema_headers, csv_headers, files_to_matches,
 
     return final_intersections
 
-def plan_join(files, schema_headers, verbose=False):
+def find_header_intersection_gpt(schema_headers, csv_headers, files_to_matches, print_results=False, prefilter=False, join_candidates=None):
+    """
+    Given the set of files + column headers that we need to join across, find the column most similar
+    across each pair that will be the target of the join. With `prefilter`, only pairs the
+    JoinPrefilter can't decide from embeddings and value overlap are sent to GPT. The columns
+    in `join_candidates` (see get_join_candidates) are kept in the sample rows GPT is shown.
+
+    Return format: dict mapping filenames part of the intersection to cols that most resemble each other
+    (file1, file2) -> (best col name match in file1, best col name match in file2)
+    """
+    filenames = [fn for fn in files_to_matches.keys()]
+    intersections, ambiguous = prefilter_pairs(csv_headers, filenames, prefilter, print_results)
+
+    # build every pair's request first so they can run concurrently
+    pairs, requests = [], []
+    for i, j in ambiguous:
+        gpt_input = get_gpt_input(schema_headers, csv_headers, filenames[i], filenames[j], files_to_matches, join_candidates)
+        prompt = "Match each column from Schema 0 to a column from Schema 1 only if they represent the " + \
+                "same data. Output the answer only as a list of length-two tuples that contain the corresponding " + \
+                "columns from Schema 0 and Schema 1, with no other output.\n"
+        # prompt = "Match each column from each schema to a column from each other schema only if they represent the " + \
+        #         "same data. Output the answer only as a list of length-three tuples that contain the corresponding " + \
+        #         "columns from Schema 0 and Schema 1 as the first two values, and a comma-separated string representing " + \
+        #         "which two schemas the tuple represents, with no other output. For example, a join on Schema 0 and Schema 1 " + \
+        #         "whould have tuples of the form ('column from schema 0', 'column from schema 1', '0,1').\n\n"
+        if print_results:
+            print("gpt input:", gpt_input)
+            print()
+            print("gpt prompt:", prompt)
+            print()
+
+        record_prompt_tokens("gpt join", count_tokens(gpt_input + prompt), files=[filenames[i], filenames[j]])
+        pairs.append((i, j))
+        requests.append({
+            'model': "gpt-4",
+            'messages': [
+            {"role": "system",
+            "content": gpt_input + prompt}
+            ],
+            'temperature': 0,
+            'max_tokens': 1024
+        })
+
+    responses = run_completions(requests)
+
+    for (i, j), str_response in zip(pairs, responses):
+        cols1 = csv_headers[filenames[i]]
+        cols2 = csv_headers[filenames[j]]
+        if print_results:
+            print("gpt output:", str_response)
+
+        # Convert string into list of tuples
+        str_response = str_response.replace("[", "").replace("]", "").replace("(", "").replace(")", "").replace("'", "").replace('"', "").replace("\n", "")
+        str_response = str_response.split(", ")
+        lis_response = []
+        for s in range(0, len(str_response)-1, len(files_to_matches)):
+            schema_0_col = str_response[s]
+            schema_1_col = str_response[s+1]
+            # Find col in schema 0 and schema 1 that matches the col name (agnostic of spaces)
+            schema_0_col = match_column(schema_0_col, cols1)
+            schema_1_col = match_column(schema_1_col, cols2)
+            lis_response.append((schema_0_col, schema_1_col))
+        if print_results:
+            print("response:", lis_response)
+
+        best_intersections = [(1, c1, c2) for c1, c2 in lis_response]
+        new_intersections = [(sim, filenames[i], filenames[j], col1, col2) for sim, col1, col2 in best_intersections]
+
+        intersections.extend(new_intersections)
+
+    return select_intersections(intersections, files_to_matches)
+
+def get_schema_description(idx, file_name, keep_columns=None):
+    """
+    Header and sample rows of one file, as it appears in a batched prompt
+    """
+    header, data, _ = build_table_excerpt(file_name, keep_columns=keep_columns)
+    return f"Schema {idx}:\n" + header + "\n" + f"Sample rows from Schema {idx}:\n" + data + "\n\n"
+
+def chunk_schemas(descriptions, max_prompt_tokens):
+    """
+    Group schema indexes into blocks of at most half the prompt budget, so any two
+    blocks fit in one prompt together
+    """
+    blocks, block, block_tokens = [], [], 0
+    for idx, description in enumerate(descriptions):
+        tokens = count_tokens(description)
+        if block and block_tokens + tokens > max_prompt_tokens // 2:
+            blocks.append(block)
+            block, block_tokens = [], 0
+        block.append(idx)
+        block_tokens += tokens
+    if block:
+        blocks.append(block)
+    return blocks
+
+def parse_batched_response(str_response):
+    """
+    Parse the JSON list of matches in a batched response, tolerating code fences
+    and text around it
+    """
+    start, end = str_response.find("["), str_response.rfind("]")
+    if start == -1 or end < start:
+        return []
+    try:
+        matches = json.loads(str_response[start:end+1])
+    except ValueError:
+        return []
+    return [match for match in matches if isinstance(match, dict)]
+
+def find_header_intersection_gpt_batched(schema_headers, csv_headers, files_to_matches, print_results=False, max_prompt_tokens=GPT_CONTEXT_TOKENS-BATCHED_RESPONSE_TOKENS, prefilter=False, join_candidates=None):
+    """
+    Same as find_header_intersection_gpt, but each file's header and sample rows are sent
+    once and GPT answers for all file pairs in a single JSON response. If the files
+    don't fit in `max_prompt_tokens`, they're split into blocks and each pair of blocks
+    gets one request.
+    """
+    all_filenames = [fn for fn in files_to_matches.keys()]
+    intersections, ambiguous = prefilter_pairs(csv_headers, all_filenames, prefilter, print_results)
+
+    # only files in a pair left for GPT are described to it
+    filenames = [fn for idx, fn in enumerate(all_filenames) if any(idx in pair for pair in ambiguous)]
+    ambiguous = set((filenames.index(all_filenames[i]), filenames.index(all_filenames[j])) for i, j in ambiguous)
+    descriptions = [
+        get_schema_description(idx, file_name, get_relevant_columns(file_name, csv_headers, files_to_matches, [f for f in filenames if f != file_name], join_candidates))
+        for idx, file_name in enumerate(filenames)
+    ]
+    blocks = chunk_schemas(descriptions, max_prompt_tokens)
+
+    requests, chunk_schema_idxs = [], []
+    for b1 in range(len(blocks)):
+        for b2 in range(b1, len(blocks)):
+            idxs = blocks[b1] if b1 == b2 else blocks[b1] + blocks[b2]
+            # pairs within a block are asked for once, in that block's own request
+            pairs = [(i, j) for i in idxs for j in idxs if i < j and (b1 == b2 or (i in blocks[b1]) != (j in blocks[b1]))]
+            pairs = [pair for pair in pairs if pair in ambiguous]
+            if len(pairs) == 0:
+                continue
+
+            gpt_input = "".join(descriptions[idx] for idx in idxs)
+            gpt_input += "Final schema headers:\n" + ", ".join(schema_headers) + "\n\n"
+            prompt = "For each of these pairs of schemas: " + ", ".join(f"({i}, {j})" for i, j in pairs) + ", " + \
+                    "match each column from the first schema to a column from the second schema only if they " + \
+                    "represent the same data. Output the answer only as a JSON list of objects of the form " + \
+                    '{"schemas": [first schema number, second schema number], "columns": [column from first schema, ' + \
+                    'column from second schema]}, with no other output.\n'
+            if print_results:
+                print("gpt input:", gpt_input)
+                print()
+                print("gpt prompt:", prompt)
+                print()
+
+            record_prompt_tokens("gpt join batched", count_tokens(gpt_input + prompt), files=[filenames[idx] for idx in idxs])
+            chunk_schema_idxs.append(set(idxs))
+            requests.append({
+                'model': "gpt-4",
+                'messages': [
+                {"role": "system",
+                "content": gpt_input + prompt}
+                ],
+                'temperature': 0,
+                'max_tokens': BATCHED_RESPONSE_TOKENS
+            })
+
+    if print_results:
+        print(f"batched {len(filenames) * (len(filenames) - 1) // 2} file pairs into {len(requests)} requests")
+
+    for idxs, str_response in zip(chunk_schema_idxs, run_completions(requests)):
+        if print_results:
+            print("gpt output:", str_response)
+
+        for match in parse_batched_response(str_response):
+            try:
+                (i, j), (col1, col2) = [int(idx) for idx in match["schemas"]], match["columns"]
+            except (KeyError, TypeError, ValueError):
+                continue
+            if i > j:
+                i, j, col1, col2 = j, i, col2, col1
+            if (i, j) not in ambiguous or i not in idxs or j not in idxs:
+                continue
+            col1 = match_column(str(col1), csv_headers[filenames[i]])
+            col2 = match_column(str(col2), csv_headers[filenames[j]])
+            intersections.append((1, filenames[i], filenames[j], col1, col2))
+
+    if print_results:
+        print("response:", intersections)
+
+    return select_intersections(intersections, files_to_matches)
+
+def plan_join(files, schema_headers, verbose=False, batched=False, prefilter=False):
     """
     Given the set of files and the schema headers, plan the join by finding the best column match
-    for each schema header across all files
+    for each schema header across all files. With `batched`, GPT matches columns for all file
+    pairs at once (see find_header_intersection_gpt_batched). `prefilter` (True or a
+    JoinPrefilter) opts in to settling the pairs embeddings and value overlap can decide
+    without GPT; its thresholds aren't tuned yet, so by default every pair goes to GPT.
 
     Return format: dict mapping schema header -> (file best match is found in, name of best column match, similarity score)
     """
@@ -166,7 +345,10 @@ def plan_join(files, schema_headers, verbose=False):
     }
 
     if len(files_to_matches) > 1:
-        plan['intersections'] = find_header_intersection_gpt(schema_headers, csv_headers, files_to_matches, print_results=verbose)
+        find_intersections = find_header_intersection_gpt_batched if batched else find_header_intersection_gpt
+        # join keys often have different names in each file, so GPT is shown the similar headers too
+        join_candidates = get_join_candidates(csv_headers, list(files_to_matches.keys()))
+        plan['intersections'] = find_intersections(schema_headers, csv_headers, files_to_matches, print_results=verbose, prefilter=prefilter, join_candidates=join_candidates)
 
         if verbose:
             print("Intersections:", plan['intersections'])
@@ -1,38 +1,104 @@
 import csv
 import os
-import openai
 import pandas as pd
 import random
+import sys
 from dotenv import load_dotenv
 
+# the table_joins modules import each other by bare name, so make them importable
+# when this file is run directly
+table_joins_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if table_joins_directory not in sys.path:
+    sys.path.append(table_joins_directory)
+
+from gpt_optimizations.prompt_builder import build_table_excerpt, record_prompt_tokens
+from llm_client import cached_chat_completion, run_completions
+from table_metadata import get_table_metadata, open_table, write_header_overlay
+
 load_dotenv()
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
-def get_data_sample(filepath, num_lines=20, random_sample=False):
+SEEK_SAMPLE_MIN_BYTES = 1024 * 1024  # smaller files are read whole and sampled exactly
+
+
+def _read_line(f, encoding):
+    return f.readline().decode(encoding, errors='replace').rstrip('\r\n') + '\n'
+
+
+def _seek_sample(f, size, data_start, k, rng, encoding):
+    """
+    Sample up to `k` distinct lines from the uncompressed binary file `f` by seeking
+    to random byte offsets past the header and realigning to the start of the next
+    line. Reads O(k) lines regardless of the file size.
+    """
+
+    starts = set()
+    for _ in range(4 * k):  # offsets landing in an already-sampled line are retried
+        if len(starts) == k:
+            break
+        f.seek(rng.randrange(data_start, size) - 1)
+        f.readline()  # skip to the next line boundary
+        start = f.tell()
+        if start >= size:
+            start = data_start  # wrap around to the first data line
+        starts.add(start)
+
+    lines = []
+    for start in sorted(starts):
+        f.seek(start)
+        lines.append(_read_line(f, encoding))
+    return lines
+
+
+def _reservoir_sample(f, k, rng, encoding):
     """
-    Get the header and `num_lines` of data from the csv
+    One-pass reservoir sample of `k` lines from the binary stream `f`, holding
+    only the sample in memory (for compressed files we can't seek into)
     """
 
-    with open(filepath, "r") as f:
-        lines = f.readlines()
+    sample = []
+    for i, line in enumerate(f):
+        if i < k:
+            sample.append(line)
+        else:
+            j = rng.randrange(i + 1)
+            if j < k:
+                sample[j] = line
+    return [line.decode(encoding, errors='replace').rstrip('\r\n') + '\n' for line in sample]
 
-    header = lines[0]
-    data = None
 
-    if random_sample:
-        num_lines = min(num_lines, len(lines))
-        indices = random.sample(range(1, len(lines)), num_lines-1)
-        data = "".join([lines[i] for i in indices])
-    else:
-        end = min(num_lines+1, len(lines))
-        data = "".join(lines[1: end])
+def get_data_sample(filepath, num_lines=20, random_sample=False, seed=0):
+    """
+    Get the header and `num_lines` of data from the csv. With `random_sample`, the
+    lines are drawn at random (reproducibly for a given `seed`) without reading the
+    whole file.
+    """
 
-    return header, data
+    meta = get_table_metadata(filepath)
 
+    with open_table(filepath) as f:
+        header = _read_line(f, meta.encoding)
 
-def get_chat_topic(filename, header, data):
+        if not random_sample:
+            lines = [line.decode(meta.encoding, errors='replace').rstrip('\r\n') + '\n' for _, line in zip(range(num_lines), f)]
+            return header, "".join(lines)
+
+        rng = random.Random(seed)
+        k = max(num_lines - 1, 0)
+        if meta.compression is not None:
+            lines = _reservoir_sample(f, k, rng, meta.encoding)
+        elif meta.size <= SEEK_SAMPLE_MIN_BYTES:
+            lines = f.read().decode(meta.encoding, errors='replace').splitlines(keepends=False)
+            lines = [line + '\n' for line in rng.sample(lines, min(k, len(lines)))]
+        else:
+            data_start = f.tell()
+            lines = _seek_sample(f, f.seek(0, os.SEEK_END), data_start, k, rng, meta.encoding)
+
+    return header, "".join(lines)
+
+
+def get_chat_topic_request(filename, header, data):
     """
-    Use the filename and data to get a GPT-generated header for the file
+    Chat completion request asking GPT for a more representative header for the file
     """
 
     prompt = f"""
@@ -47,43 +113,46 @@ def get_chat_topic(filename, header, data):
     Data: {data}
     """
 
-    print("prompt:", prompt)
-
-    client = openai.OpenAI(api_key = OPENAI_API_KEY)
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[
+    return {
+        'model': "gpt-4",
+        'messages': [
         {"role": "system",
         "content": prompt}
         ],
-        temperature=0,
-        max_tokens=512
-    )
-    return response.choices[0].message.content
+        'temperature': 0,
+        'max_tokens': 512
+    }
+
+
+def get_chat_topic(filename, header, data):
+    """
+    Use the filename and data to get a GPT-generated header for the file
+    """
+
+    request = get_chat_topic_request(filename, header, data)
+    print("prompt:", request['messages'][0]['content'])
+
+    return cached_chat_completion(**request)
 
 
 def generate_csv(gpt_headers, filepath):
-    # Specify the path to your CSV file
-    f = open(filepath, "r")
-    lines = f.readlines()
-    lines[0] = gpt_headers
-    if gpt_headers[-1] != "\n":
-        lines[0] += "\n"
+    """
+    Make "GPT HEADER <file>" readable as `filepath` with `gpt_headers` as its first
+    line. Only a header overlay sidecar is written, not a copy of the data.
+    """
 
     directory, filename = os.path.split(filepath)
     gpt_filepath = os.path.join(directory, "GPT HEADER " + filename)
-    with open(gpt_filepath, "w") as f:
-        f.writelines(lines)
-
-    return gpt_filepath
+    return write_header_overlay(gpt_filepath, filepath, gpt_headers)
 
 def generate_gpt_header(filepath):
     """
     Given a csv file, use GPT to generate a more representative set of headers
-    and save the results in a new file
+    and save them as a header overlay of the file
     """
 
-    header, data = get_data_sample(filepath, random_sample=True)
+    header, data, tokens = build_table_excerpt(filepath)
+    record_prompt_tokens("gpt header", tokens, files=[filepath])
     filename = os.path.basename(filepath)
     gpt_headers = get_chat_topic(filename, header, data)
 
@@ -91,6 +160,21 @@ def generate_gpt_header(filepath):
 
     return generate_csv(gpt_headers, filepath)
 
+def generate_gpt_headers(filepaths):
+    """
+    generate_gpt_header for several files, with the GPT requests running concurrently.
+    Returns the overlay paths in the same order as `filepaths`.
+    """
+
+    requests = []
+    for filepath in filepaths:
+        header, data, tokens = build_table_excerpt(filepath)
+        record_prompt_tokens("gpt header", tokens, files=[filepath])
+        requests.append(get_chat_topic_request(os.path.basename(filepath), header, data))
+
+    all_gpt_headers = run_completions(requests)
+
+    return [generate_csv(gpt_headers, filepath) for gpt_headers, filepath in zip(all_gpt_headers, filepaths)]
+
 if __name__ == '__main__':
     generate_gpt_header("../available_datasets/target_type.csv")
-
@@ -0,0 +1,134 @@
+import csv
+import io
+import os
+import threading
+
+from llm_client import CHARS_PER_TOKEN
+from table_metadata import get_table_metadata
+
+PROMPT_TOKENS_ENV = "SMART_GATHER_PROMPT_TOKENS"  # token budget for each table excerpt
+
+DEFAULT_TABLE_TOKENS = 400
+SAMPLE_POOL_ROWS = 100  # rows sampled to choose the excerpt rows from
+MIN_ROWS = 3
+MIN_CELL_CHARS = 12
+ELLIPSIS = "..."
+
+_report = []
+_report_lock = threading.Lock()
+
+
+def count_tokens(text, model="gpt-4"):
+    """
+    Number of tokens in `text`, exact if tiktoken is installed, else estimated
+    """
+
+    try:
+        import tiktoken
+        return len(tiktoken.encoding_for_model(model).encode(text))
+    except (ImportError, KeyError):
+        return len(text) // CHARS_PER_TOKEN + 1
+
+
+def record_prompt_tokens(stage, tokens, **info):
+    """
+    Note the size of a prompt sent by `stage` (e.g. "gpt join")
+    """
+
+    with _report_lock:
+        _report.append(dict(stage=stage, tokens=tokens, **info))
+
+
+def get_prompt_token_report():
+    """
+    Sizes of the prompts built so far, as dicts of stage, tokens and details
+    """
+
+    with _report_lock:
+        return list(_report)
+
+
+def _truncate(value, max_chars):
+    value = " ".join(value.split())
+    if len(value) <= max_chars:
+        return value
+    return value[:max_chars - len(ELLIPSIS)] + ELLIPSIS
+
+
+def _diverse_rows(rows, num_rows):
+    """
+    Greedily pick `num_rows` rows, each adding the most (column, value) pairs not
+    already shown, so every column's range of values is represented
+    """
+
+    chosen, seen = [], set()
+    remaining = list(rows)
+    while remaining and len(chosen) < num_rows:
+        best = max(range(len(remaining)), key=lambda i: len(set(enumerate(remaining[i])) - seen))
+        row = remaining.pop(best)
+        if chosen and not set(enumerate(row)) - seen:
+            break  # nothing new left to show
+        chosen.append(row)
+        seen.update(enumerate(row))
+    return chosen
+
+
+def _render(rows, delimiter):
+    out = io.StringIO()
+    csv.writer(out, delimiter=delimiter, lineterminator="\n").writerows(rows)
+    return out.getvalue()
+
+
+def build_table_excerpt(filepath, token_budget=None, keep_columns=None, num_rows=20, max_cell_chars=40, seed=0):
+    """
+    Header and sample rows of the csv at `filepath` that fit in `token_budget` tokens.
+
+    Cell values are whitespace-collapsed and truncated to `max_cell_chars`, duplicate
+    rows are dropped and up to `num_rows` rows are chosen to show as many distinct
+    values per column as possible. Rows, then cell widths, are cut further until the
+    excerpt fits. If `keep_columns` is given, other columns are dropped when they're
+    empty in the sample, or (widest first) when the budget is still tight; otherwise
+    every column is kept, for callers that need the full header.
+
+    Returns (header, data, tokens) where `header` and `data` are csv text.
+    """
+
+    if token_budget is None:
+        token_budget = int(os.environ.get(PROMPT_TOKENS_ENV) or DEFAULT_TABLE_TOKENS)
+    from gpt_optimizations.gpt_column_headers import get_data_sample  # imports this module
+
+    delimiter = get_table_metadata(filepath).delimiter
+
+    header_line, data = get_data_sample(filepath, num_lines=SAMPLE_POOL_ROWS + 1, random_sample=True, seed=seed)
+    header = next(csv.reader([header_line], delimiter=delimiter), [])
+    rows = [row for row in csv.reader(io.StringIO(data), delimiter=delimiter) if row]
+    if any(len(row) == len(header) for row in rows):
+        rows = [row for row in rows if len(row) == len(header)]  # drop rows split by quoted newlines
+
+    columns = list(range(len(header)))
+    if keep_columns is not None:
+        keep = set(col.strip() for col in keep_columns)
+        columns = [i for i in columns if header[i].strip() in keep or any(i < len(row) and row[i].strip() for row in rows)]
+
+    def excerpt(columns, num_rows, max_cell_chars):
+        cells = [[_truncate(row[i], max_cell_chars) if i < len(row) else "" for i in columns] for row in rows]
+        unique = list(dict.fromkeys(tuple(row) for row in cells))
+        header_text = _render([[header[i] for i in columns]], delimiter)
+        data_text = _render(_diverse_rows(unique, num_rows), delimiter)
+        return header_text, data_text, count_tokens(header_text + data_text)
+
+    header_text, data_text, tokens = excerpt(columns, num_rows, max_cell_chars)
+    while tokens > token_budget:
+        if num_rows > MIN_ROWS:
+            num_rows = max(MIN_ROWS, num_rows * 2 // 3)
+        elif max_cell_chars > MIN_CELL_CHARS:
+            max_cell_chars = max(MIN_CELL_CHARS, max_cell_chars // 2)
+        elif keep_columns is not None and any(header[i].strip() not in keep for i in columns):
+            droppable = [i for i in columns if header[i].strip() not in keep]
+            widest = max(droppable, key=lambda i: sum(len(row[i]) for row in rows if i < len(row)))
+            columns = [i for i in columns if i != widest]
+        else:
+            break  # as small as it gets
+        header_text, data_text, tokens = excerpt(columns, num_rows, max_cell_chars)
+
+    return header_text, data_text, tokens
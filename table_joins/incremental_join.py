@@ -0,0 +1,419 @@
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from memory_governor import read_frame, write_frame
+from multi_table_join import MultiTableJoin
+from row_hash_set import hash_rows, runs_contain
+from table_metadata import get_table_metadata, open_table
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 3
+MAX_INDEX_PARTS = 8  # a key index with more parts than this is compacted into one
+MAX_HASH_RUNS = 8  # likewise for the sorted runs of output row hashes
+
+
+def matching_rows(df, keys):
+    """
+    Rows of `df` whose columns hold one of the values given for them in `keys`
+    ({column: values})
+    """
+
+    mask = np.ones(len(df), dtype=bool)
+    for col, values in keys.items():
+        mask &= df[col].isin(values).to_numpy()
+    return df[mask]
+
+
+def _read_index_part(path, keys):
+    if keys and path.endswith('.parquet'):
+        # let Parquet skip what its statistics rule out rather than decode everything
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        try:
+            condition = None
+            for col, values in keys.items():
+                expression = pc.field(col).isin(pa.array(values, from_pandas=True))
+                condition = expression if condition is None else condition & expression
+            df = pd.read_parquet(path, filters=condition)
+        except (pa.ArrowException, TypeError, ValueError):
+            df = read_frame(path)
+    else:
+        df = read_frame(path)
+    return matching_rows(df, keys) if keys else df
+
+
+def read_index(parts, keys=None):
+    """
+    Key index stored as the Parquet (or pickle) files `parts`. With `keys`
+    ({column: values}) only the rows matching them are read.
+    """
+
+    if len(parts) == 1:
+        return _read_index_part(parts[0], keys)
+    return pd.concat([_read_index_part(path, keys) for path in parts], ignore_index=True)
+
+
+class IncrementalJoin:
+    """
+    A materialised MultiTableJoin result over append-only source CSVs.
+
+    The first refresh() runs the full join and persists, per input, the byte offset
+    processed so far, a fingerprint of the last processed line and a "key index"
+    (the columns needed for joins and projections). Later refreshes read only the
+    rows appended since, join each delta against the rows of the other inputs'
+    persisted indexes it can match using the join columns chosen by the first run,
+    and append the new deduplicated rows to the output file. Only complete lines are
+    processed: a last line without a newline is left for the next refresh, as it may
+    still be being written. If a source was rewritten rather than
+    appended to, or the join definition changed, the result is rebuilt from scratch.
+
+    State is only ever appended to: each refresh adds its deltas to the key indexes
+    as new parts and the hashes of its output rows as a new sorted run, so what it
+    writes is proportional to the new rows. Once an index has more than
+    MAX_INDEX_PARTS parts (or the output more than MAX_HASH_RUNS runs) they're
+    compacted into one.
+    """
+
+    def __init__(self, intersections_to_join_cols, schema_headers, files_to_cols, output_file, state_dir=None):
+        """Initializes an IncrementalJoin object
+
+        Args:
+            intersections_to_join_cols (dict): {(file_1, file_2): [(col_1, col_2, similarity), ...]}
+            schema_headers (list): list of requested headers for schema
+            files_to_cols (dict): {file: [(col_1, schema_col_1), (col_2, schema_col_2), ...]}
+            output_file (str): csv the materialised result is written and appended to
+            state_dir (str): where offsets, fingerprints and key indexes are kept
+                (defaults to `<output_file>.state`)
+        """
+
+        self.intersections_to_join_cols = {
+            pair: [join_cols] if isinstance(join_cols, tuple) else list(join_cols)
+            for pair, join_cols in intersections_to_join_cols.items()
+        }
+        self.schema_headers = schema_headers
+        self.files_to_cols = files_to_cols
+        self.output_file = output_file
+        self.state_dir = state_dir or output_file + '.state'
+
+        self.files = []
+        for file_1, file_2 in self.intersections_to_join_cols:
+            for file in (file_1, file_2):
+                if file not in self.files:
+                    self.files.append(file)
+
+    def _config_fingerprint(self):
+        config = [
+            sorted((list(pair), [list(jc) for jc in join_cols]) for pair, join_cols in self.intersections_to_join_cols.items()),
+            self.schema_headers,
+            sorted((file, [list(m) for m in matches]) for file, matches in (self.files_to_cols or {}).items()),
+        ]
+        return hashlib.sha256(json.dumps(config, default=str).encode()).hexdigest()
+
+    def _read_manifest(self):
+        path = os.path.join(self.state_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_manifest(self):
+        manifest = self._read_manifest()
+        if manifest is None or not os.path.exists(self.output_file):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('config') != self._config_fingerprint():
+            return None
+        return manifest
+
+    def _save_manifest(self, manifest):
+        path = os.path.join(self.state_dir, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(path + '.tmp', path)
+
+    def _state_files(self, manifest):
+        """
+        Index parts and hash runs `manifest` refers to
+        """
+
+        if manifest is None:
+            return set()
+        files = set(manifest.get('output_hashes', []))
+        for state in manifest.get('files', {}).values():
+            files.update(state.get('index_parts', []))
+        return files
+
+    def _remove_state_files(self, paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_index_part(self, df, i, generation):
+        return write_frame(df, os.path.join(self.state_dir, f"index_{i}_{generation}"))
+
+    def _write_hash_run(self, hashes, generation):
+        path = os.path.join(self.state_dir, f"output_hashes_{generation}.npy")
+        np.save(path, hashes)
+        return path
+
+    def _needed_columns(self, filename, join_cols_by_pair, columns):
+        """
+        Columns of `filename` that joins or the schema projection use
+        """
+
+        if self.files_to_cols is None:
+            return list(columns)
+
+        needed = set(col for col, _ in self.files_to_cols.get(filename, []))
+        for (file_1, file_2), join_cols in join_cols_by_pair.items():
+            for jc in join_cols:
+                if file_1 == filename:
+                    needed.add(jc[0])
+                if file_2 == filename:
+                    needed.add(jc[1])
+        return [col for col in columns if col in needed]
+
+    def _read_source(self, filename, offset=0, state=None):
+        """
+        Read `filename` from byte `offset` on. Returns (df, file info) where the file
+        info holds the new offset and last-line fingerprint. With `state`, parse the
+        bytes as headerless rows using the columns and delimiter recorded in `state`.
+        """
+
+        # offsets are into the decompressed stream for compressed sources
+        with open_table(filename) as f:
+            f.seek(offset)
+            data = f.read()
+
+        # stop after the last newline, as a writer may be part way through the last line
+        end = data.rfind(b'\n') + 1
+        if end > 0 or state is not None:
+            data = data[:end]
+
+        info = dict(state) if state is not None else {}
+        info['offset'] = offset + len(data)
+        stripped = data.rstrip(b'\r\n')
+        if stripped:
+            last_line = stripped.rsplit(b'\n', 1)[-1]
+            info['last_line_length'] = len(data) - (len(stripped) - len(last_line))
+            info['last_line_hash'] = hashlib.sha256(last_line).hexdigest()
+
+        if state is None:
+            meta = get_table_metadata(filename)
+            df = pd.read_csv(io.BytesIO(data), sep=meta.delimiter, encoding=meta.encoding)
+
+            # trim whitespace from headers
+            df.columns = [col.strip() for col in df.columns]
+            info['delimiter'] = meta.delimiter
+            info['columns'] = list(df.columns)
+        elif data.strip():
+            df = pd.read_csv(io.BytesIO(data), sep=state['delimiter'], header=None, names=state['columns'])
+        else:
+            df = pd.DataFrame(columns=state['columns'])
+
+        return df, info
+
+    def _source_appended(self, filename, state):
+        """
+        Check that `filename` still starts with the bytes we've already processed,
+        i.e. it was only appended to since the last refresh
+        """
+
+        try:
+            meta = get_table_metadata(filename)
+        except OSError:
+            return False
+        if meta.compression is None and meta.overlay is None and meta.size < state['offset']:
+            return False
+        if 'last_line_hash' not in state:
+            return True
+
+        with open_table(filename) as f:
+            f.seek(state['offset'] - state['last_line_length'])
+            tail = f.read(state['last_line_length'])
+        return hashlib.sha256(tail.rstrip(b'\r\n')).hexdigest() == state['last_line_hash']
+
+    def _cast_like(self, delta, dtypes):
+        # parse appended rows into the dtypes of the persisted index so joins line up
+        for col in delta.columns:
+            if col in dtypes and str(delta[col].dtype) != dtypes[col]:
+                try:
+                    delta[col] = delta[col].astype(dtypes[col])
+                except (ValueError, TypeError):
+                    pass
+        return delta
+
+    def _affected_rows(self, filename, delta, join_cols_by_pair, states, appended):
+        """
+        Inputs for joining `delta`, the new rows of `filename`: for each other input,
+        the rows of its key index (and of its delta in `appended`, if any) that can
+        join with the delta. They're found by following the join columns out from
+        `filename`; the joins are inner joins, so no other rows can reach the output.
+        """
+
+        def rows(file, keys):
+            df = read_index(states[file]['index_parts'], keys)
+            if file in appended:
+                df = pd.concat([df, matching_rows(appended[file], keys) if keys else appended[file]], ignore_index=True)
+            return df
+
+        frames = {filename: delta}
+        queue = [filename]
+        while queue:
+            file = queue.pop(0)
+            for (file_1, file_2), join_cols in join_cols_by_pair.items():
+                if file not in (file_1, file_2):
+                    continue
+                other = file_2 if file == file_1 else file_1
+                if other in frames:
+                    continue
+
+                keys = {}
+                for jc in join_cols:
+                    col, other_col = (jc[0], jc[1]) if file == file_1 else (jc[1], jc[0])
+                    keys[other_col] = frames[file][col].unique()
+                frames[other] = rows(other, keys)
+                queue.append(other)
+
+        for file in self.files:
+            if file not in frames:
+                frames[file] = rows(file, None)
+        return {file: frames[file] for file in self.files}
+
+    def _join(self, frames, join_cols_by_pair, rank_join_cols):
+        join = MultiTableJoin(join_cols_by_pair, self.schema_headers, self.files_to_cols, rank_join_cols=rank_join_cols)
+        for filename, df in frames.items():
+            join.set_df(filename, df.copy(deep=False))  # joins rename columns in place
+        return join, join.get_result()
+
+    def rebuild(self, verbose=False) -> pd.DataFrame:
+        """
+        Run the full join, write it to the output file and persist the state
+        needed for later incremental refreshes
+        """
+
+        frames, states = {}, {}
+        for filename in self.files:
+            frames[filename], states[filename] = self._read_source(filename)
+
+        join, result = self._join(frames, self.intersections_to_join_cols, rank_join_cols=True)
+        if result is None:
+            return None
+        result.to_csv(self.output_file, index=False)
+
+        # new files never overwrite those of the state being replaced
+        old_manifest = self._read_manifest()
+        generation = old_manifest.get('generation', 0) + 1 if old_manifest is not None else 1
+
+        join_cols_by_pair = join.chosen_join_cols
+        os.makedirs(self.state_dir, exist_ok=True)
+        for i, filename in enumerate(self.files):
+            df = frames[filename]
+            df = df[self._needed_columns(filename, join_cols_by_pair, df.columns)]
+            states[filename]['index_columns'] = list(df.columns)
+            states[filename]['index_dtypes'] = {col: str(dtype) for col, dtype in df.dtypes.items()}
+            states[filename]['index_parts'] = [self._write_index_part(df, i, generation)]
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'config': self._config_fingerprint(),
+            'generation': generation,
+            'join_cols': [[file_1, file_2, join_cols] for (file_1, file_2), join_cols in join_cols_by_pair.items()],
+            'files': states,
+            'output_hashes': [self._write_hash_run(np.unique(hash_rows(result)), generation)],
+        }
+        self._save_manifest(manifest)
+        self._remove_state_files(self._state_files(old_manifest) - self._state_files(manifest))
+
+        if verbose:
+            print(f"rebuilt {self.output_file} with {len(result)} rows")
+        return result
+
+    def refresh(self, verbose=False) -> pd.DataFrame:
+        """
+        Bring the output file up to date with rows appended to the sources since the
+        last refresh. Returns the rows appended to the output (everything on a rebuild).
+        """
+
+        manifest = self._load_manifest()
+        if manifest is None or not all(self._source_appended(f, manifest['files'][f]) for f in self.files):
+            return self.rebuild(verbose)
+
+        join_cols_by_pair = {(file_1, file_2): [tuple(jc) for jc in join_cols] for file_1, file_2, join_cols in manifest['join_cols']}
+        states = manifest['files']
+        generation = manifest['generation'] + 1
+
+        deltas = {}
+        for filename in self.files:
+            delta, states[filename] = self._read_source(filename, states[filename]['offset'], states[filename])
+            if len(delta) > 0:
+                deltas[filename] = delta[states[filename]['index_columns']]
+
+        if verbose:
+            print("delta rows:", {filename: len(delta) for filename, delta in deltas.items()})
+
+        result = pd.DataFrame(columns=self.schema_headers)
+        obsolete = []
+        if len(deltas) > 0:
+            for filename, delta in deltas.items():
+                deltas[filename] = self._cast_like(delta, states[filename]['index_dtypes'])
+
+            # result(new) = result(old) + sum_i join(new_1, ..., new_{i-1}, delta_i, old_{i+1}, ...)
+            # where each delta is joined against only the rows of the other inputs it can match
+            new_rows = []
+            appended = {}
+            for filename in self.files:
+                if filename not in deltas:
+                    continue
+                inputs = self._affected_rows(filename, deltas[filename], join_cols_by_pair, states, appended)
+                appended[filename] = deltas[filename]
+                if any(len(df) == 0 for df in inputs.values()):
+                    continue
+                _, rows = self._join(inputs, join_cols_by_pair, rank_join_cols=False)
+                if rows is None:
+                    return None
+                new_rows.append(rows)
+
+            if new_rows:
+                result = pd.concat(new_rows, ignore_index=True).drop_duplicates()
+            hashes = hash_rows(result)
+            runs = [np.load(path, mmap_mode='r') for path in manifest['output_hashes']]
+            is_new = ~runs_contain(runs, hashes)
+            result = result[is_new]
+            result.to_csv(self.output_file, mode='a', header=False, index=False)
+
+            new_hashes = np.unique(hashes[is_new])
+            if len(runs) >= MAX_HASH_RUNS:
+                obsolete.extend(manifest['output_hashes'])
+                manifest['output_hashes'] = [self._write_hash_run(np.unique(np.concatenate(runs + [new_hashes])), generation)]
+            elif len(new_hashes) > 0:
+                manifest['output_hashes'].append(self._write_hash_run(new_hashes, generation))
+            del runs
+
+            for i, filename in enumerate(self.files):
+                if filename not in deltas:
+                    continue
+                parts = states[filename]['index_parts']
+                if len(parts) >= MAX_INDEX_PARTS:
+                    obsolete.extend(parts)
+                    index = pd.concat([read_index(parts), deltas[filename]], ignore_index=True)
+                    states[filename]['index_parts'] = [self._write_index_part(index, i, generation)]
+                else:
+                    parts.append(self._write_index_part(deltas[filename], i, generation))
+
+        manifest['generation'] = generation
+        manifest['files'] = states
+        self._save_manifest(manifest)
+        self._remove_state_files(obsolete)
+
+        if verbose:
+            print(f"appended {len(result)} rows to {self.output_file}")
+        return result
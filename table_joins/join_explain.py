@@ -0,0 +1,123 @@
+import json
+import time
+import tracemalloc
+
+from table_metadata import get_table_metadata
+
+
+class ExplainNode:
+    """A single step in an EXPLAIN ANALYZE tree
+
+    Fields:
+        name: short description of the step (e.g. "join a.csv and b.csv")
+        info: dict of measurements and plan details for the step
+        children: sub-steps, in execution order
+    """
+
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.children = []
+        self.peak_memory = None  # absolute traced peak, set by StepTimer
+
+    def add_child(self, name, **info):
+        child = ExplainNode(name, **info)
+        self.children.append(child)
+        return child
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            **self.info,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent, default=str)
+
+    def to_text(self, depth=0):
+        pad = '  ' * depth
+        lines = [pad + ('-> ' if depth else '') + self.name]
+        for key, value in self.info.items():
+            lines.append(f"{pad}     {key}: {_format_value(key, value)}")
+        for child in self.children:
+            lines.append(child.to_text(depth + 1))
+        return '\n'.join(lines)
+
+    def render(self, format='text'):
+        if format == 'text':
+            return self.to_text()
+        elif format == 'json':
+            return self.to_json()
+        raise ValueError(f"unknown explain format {format}")
+
+    def __str__(self):
+        return self.to_text()
+
+
+class StepTimer:
+    """
+    Records wall time and (optionally) peak traced memory of a step into an
+    ExplainNode's info. Use as a context manager or call start()/stop().
+    A None node makes the timer a no-op.
+    """
+
+    def __init__(self, node, trace_memory=False):
+        self.node = node
+        self.trace_memory = trace_memory and node is not None
+
+    def start(self):
+        self.started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start_time = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self.node is None:
+            return
+        self.node.info['wall_time_s'] = round(time.perf_counter() - self.start_time, 6)
+        if self.trace_memory:
+            # children reset the tracemalloc peak, so fold their peaks back in
+            peak = max(
+                [tracemalloc.get_traced_memory()[1]] +
+                [child.peak_memory for child in self.node.children if child.peak_memory is not None]
+            )
+            self.node.peak_memory = peak
+            self.node.info['peak_memory_bytes'] = max(0, peak - self.start_memory)
+            if self.started_tracing:
+                tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self.node
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+
+def file_size(filename):
+    """
+    Number of bytes that reading `filename` will pull from disk (0 if unknown)
+    """
+
+    try:
+        return get_table_metadata(filename).size  # the source's size for header overlays
+    except OSError:
+        return 0
+
+
+def _format_value(key, value):
+    if key.endswith('_bytes') and isinstance(value, int):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if abs(value) < 1024 or unit == 'GB':
+                return f"{value:.1f} {unit}" if unit != 'B' else f"{value} B"
+            value /= 1024
+    if key.endswith('_s') and isinstance(value, float):
+        return f"{value * 1000:.2f} ms"
+    return value
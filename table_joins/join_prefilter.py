@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from csv_helpers import read_csv
+from manual_join import get_best_intersections
+from table_metadata import get_table_metadata
+
+PREFILTER_LOG_ENV = "SMART_GATHER_PREFILTER_LOG"  # jsonl file prefilter decisions are appended to
+
+SKETCH_SIZE = 256  # hashes kept per column
+MAX_HEADER_CANDIDATES = 5  # most similar header pairs whose values are compared
+
+ACCEPT, REJECT, AMBIGUOUS = "accept", "reject", "ambiguous"
+
+
+class ValueSketch:
+    """
+    K-minimum-values sketch of a column's distinct values, for estimating how much
+    two columns' values overlap without comparing them in full
+
+    Fields:
+        hashes: the `SKETCH_SIZE` smallest 64-bit hashes of the normalised values
+        distinct: number of distinct non-null values
+    """
+
+    def __init__(self, hashes, distinct):
+        self.hashes = hashes
+        self.distinct = distinct
+
+    @classmethod
+    def from_series(cls, series):
+        values = series.dropna()
+        if pd.api.types.is_float_dtype(values):
+            # so 3.0 in one file matches 3 in another
+            values = values.map(lambda v: str(int(v)) if v.is_integer() else str(v))
+        values = values.astype(str).str.strip().str.lower()
+        hashes = np.unique(pd.util.hash_array(values.to_numpy(dtype=object)))
+        return cls(hashes[:SKETCH_SIZE], len(hashes))
+
+    def jaccard(self, other):
+        if self.distinct == 0 or other.distinct == 0:
+            return 0.0
+        union = np.union1d(self.hashes, other.hashes)[:SKETCH_SIZE]
+        both = np.intersect1d(np.intersect1d(self.hashes, other.hashes), union)
+        return len(both) / len(union)
+
+    def containment(self, other):
+        """
+        Estimated fraction of the smaller column's distinct values found in the larger
+        """
+
+        j = self.jaccard(other)
+        if j == 0:
+            return 0.0
+        intersection = j * (self.distinct + other.distinct) / (1 + j)
+        return min(1.0, intersection / min(self.distinct, other.distinct))
+
+
+class JoinPrefilter:
+    """
+    Decides which file pairs need GPT to find their join columns.
+
+    Each pair's columns are compared by GloVe header similarity (as in manual_join)
+    and, for the most similar header pairs, by estimated value overlap:
+        accept: a header pair is at least `accept_similarity` similar and its values
+            overlap by at least `accept_overlap`, so it's used without asking GPT
+        reject: no header pair is `reject_similarity` similar and no compared values
+            overlap by `reject_overlap`, so the files aren't joinable and GPT is skipped
+        ambiguous: anything else is left to GPT
+
+    Every decision is kept in `decisions` and appended as a json line to `log_file`
+    (default $SMART_GATHER_PREFILTER_LOG), with the scores behind it, so the thresholds
+    can be tuned against join_metrics results.
+    """
+
+    def __init__(self, embedding_space, accept_similarity=0.9, accept_overlap=0.5, reject_similarity=0.5, reject_overlap=0.05, log_file=None, verbose=False):
+        self.embedding_space = embedding_space
+        self.accept_similarity = accept_similarity
+        self.accept_overlap = accept_overlap
+        self.reject_similarity = reject_similarity
+        self.reject_overlap = reject_overlap
+        self.log_file = log_file or os.environ.get(PREFILTER_LOG_ENV)
+        self.verbose = verbose
+        self.decisions = []
+
+        self._sketches = {}  # {(fingerprint, column): ValueSketch}
+
+    def _sketch(self, filename, col):
+        key = (get_table_metadata(filename).fingerprint, col)
+        if key not in self._sketches:
+            series = read_csv(filename, usecols=[col])[col]
+            self._sketches[key] = ValueSketch.from_series(series)
+        return self._sketches[key]
+
+    def _candidates(self, cols1, cols2):
+        candidates = get_best_intersections(cols1, cols2, self.embedding_space)
+        return [(sim, c1, c2) for sim, c1, c2 in candidates if c1 != '' and c2 != ''][:MAX_HEADER_CANDIDATES]
+
+    def decide(self, file_1, file_2, cols1, cols2):
+        """
+        Decision for one file pair, as (ACCEPT | REJECT | AMBIGUOUS, join columns),
+        where the join columns [(col_1, col_2, score), ...] are only set on ACCEPT
+        """
+
+        scored = []
+        for sim, c1, c2 in self._candidates(cols1, cols2):
+            try:
+                overlap = self._sketch(file_1, c1).containment(self._sketch(file_2, c2))
+            except (KeyError, ValueError):
+                overlap = 0.0
+            scored.append((sim, overlap, c1, c2))
+
+        accepted = [(c1, c2, sim) for sim, overlap, c1, c2 in scored if sim >= self.accept_similarity and overlap >= self.accept_overlap]
+        if accepted:
+            decision = ACCEPT
+        elif all(sim < self.reject_similarity and overlap < self.reject_overlap for sim, overlap, _, _ in scored):
+            decision = REJECT
+        else:
+            decision = AMBIGUOUS
+
+        self._log({
+            'time': time.time(),
+            'files': [file_1, file_2],
+            'decision': decision,
+            'candidates': [{'columns': [c1, c2], 'similarity': round(float(sim), 4), 'overlap': round(float(overlap), 4)} for sim, overlap, c1, c2 in scored],
+            'thresholds': {
+                'accept_similarity': self.accept_similarity,
+                'accept_overlap': self.accept_overlap,
+                'reject_similarity': self.reject_similarity,
+                'reject_overlap': self.reject_overlap,
+            },
+        })
+        return decision, accepted
+
+    def _log(self, entry):
+        self.decisions.append(entry)
+        if self.verbose:
+            print("prefilter:", entry['files'], entry['decision'], entry['candidates'][:1])
+        if self.log_file:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def split_pairs(self, csv_headers, filenames):
+        """
+        Run the prefilter on every pair of `filenames`. Returns the (similarity, file1,
+        file2, col1, col2) intersections of accepted pairs and the (i, j) index pairs
+        left for GPT.
+        """
+
+        intersections, ambiguous = [], []
+        for i in range(len(filenames)):
+            for j in range(i+1, len(filenames)):
+                decision, join_cols = self.decide(filenames[i], filenames[j], csv_headers[filenames[i]], csv_headers[filenames[j]])
+                if decision == ACCEPT:
+                    intersections.extend((sim, filenames[i], filenames[j], c1, c2) for c1, c2, sim in join_cols)
+                elif decision == AMBIGUOUS:
+                    ambiguous.append((i, j))
+        return intersections, ambiguous
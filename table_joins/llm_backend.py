@@ -0,0 +1,291 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_cache import request_key
+
+LLM_BACKEND_ENV = "SMART_GATHER_LLM_BACKEND"  # "openai" (default), "stub" or "replay"
+LLM_REPLAY_FILE_ENV = "SMART_GATHER_LLM_REPLAY_FILE"
+LLM_LATENCY_ENV = "SMART_GATHER_LLM_LATENCY"  # seconds added to each stand-in response
+
+
+class LLMBackend:
+    """
+    Where chat completion requests are sent. Subclasses implement complete() and
+    acomplete(), both returning the content of the response.
+
+    Fields:
+        name: short name of the backend
+        cacheable: whether responses may be stored in the shared LLM response cache
+    """
+
+    name = None
+    cacheable = False
+
+    def complete(self, model, messages, temperature=0, max_tokens=None):
+        raise NotImplementedError
+
+    async def acomplete(self, model, messages, temperature=0, max_tokens=None):
+        return await asyncio.to_thread(self.complete, model, messages, temperature, max_tokens)
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI API (or any server speaking it, via `base_url`). Clients are created
+    on first use, so importing the pipeline needs no API key or network.
+    """
+
+    name = "openai"
+    cacheable = True
+
+    def __init__(self, api_key=None, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self._async_client = None
+
+    def _kwargs(self):
+        return {'api_key': self.api_key or os.environ.get("OPENAI_API_KEY"), 'base_url': self.base_url}
+
+    def complete(self, model, messages, temperature=0, max_tokens=None):
+        if self._client is None:
+            import openai
+            self._client = openai.OpenAI(**self._kwargs())
+        response = self._client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+    async def acomplete(self, model, messages, temperature=0, max_tokens=None):
+        if self._async_client is None:
+            import openai
+            # AsyncLLMClient does the retrying, so the rate limiter sees every attempt
+            self._async_client = openai.AsyncOpenAI(max_retries=0, **self._kwargs())
+        response = await self._async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Serves responses recorded in a JSON file ({request hash: content}), after an
+    injected `latency`. Requests that weren't recorded are sent to `fallback` (and
+    recorded) if one is given, else raise KeyError.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, fallback=None, latency=0.0):
+        self.path = path
+        self.fallback = fallback
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._responses = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._responses = json.load(f)
+
+    def _lookup(self, key):
+        with self._lock:
+            return self._responses.get(key)
+
+    def _record(self, key, content):
+        with self._lock:
+            self._responses[key] = content
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._responses, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def complete(self, model, messages, temperature=0, max_tokens=None):
+        key = request_key(model, messages, temperature, max_tokens)
+        content = self._lookup(key)
+        if content is None:
+            if self.fallback is None:
+                raise KeyError(f"no recorded response for request {key}")
+            content = self.fallback.complete(model, messages, temperature, max_tokens)
+            self._record(key, content)
+        elif self.latency:
+            time.sleep(self.latency)
+        return content
+
+    async def acomplete(self, model, messages, temperature=0, max_tokens=None):
+        key = request_key(model, messages, temperature, max_tokens)
+        content = self._lookup(key)
+        if content is None:
+            if self.fallback is None:
+                raise KeyError(f"no recorded response for request {key}")
+            content = await self.fallback.acomplete(model, messages, temperature, max_tokens)
+            self._record(key, content)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        return content
+
+
+def stub_response(messages):
+    """
+    Deterministic stand-in answer: the current header for header prompts, no
+    matches for join prompts, and a hash of the prompt otherwise
+    """
+
+    prompt = messages[-1]['content']
+    header = re.search(r"Header: (.*)\n", prompt)
+    if header:
+        return header.group(1)
+    if "JSON" in prompt or "tuples" in prompt:
+        return "[]"
+    return "stub " + hashlib.sha256(prompt.encode()).hexdigest()[:8]
+
+
+class StubLLMServer:
+    """
+    Local HTTP server answering OpenAI chat completion requests with
+    `responder(messages)` after an injected `latency` (seconds, plus up to `jitter`).
+    A fraction `error_rate` of requests fail with 429 to exercise retries. Point an
+    OpenAIBackend at `base_url` to run the GPT paths offline.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, responder=stub_response, seed=0, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.responder = responder
+        self.requests = 0
+        self.errors = 0
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                with stub._lock:
+                    stub.requests += 1
+                    delay = stub.latency + stub._rng.uniform(0, stub.jitter)
+                    fail = stub._rng.random() < stub.error_rate
+                    stub.errors += fail
+                time.sleep(delay)
+
+                if not self.path.endswith('/chat/completions'):
+                    self._send(404, {'error': {'message': f"unknown path {self.path}"}})
+                elif fail:
+                    self._send(429, {'error': {'message': "injected rate limit", 'type': 'rate_limit_error'}})
+                else:
+                    content = stub.responder(request['messages'])
+                    prompt_tokens = sum(len(m['content']) for m in request['messages']) // 4
+                    self._send(200, {
+                        'id': f"stub-{stub.requests}",
+                        'object': 'chat.completion',
+                        'created': int(time.time()),
+                        'model': request.get('model'),
+                        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+                        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4, 'total_tokens': prompt_tokens + len(content) // 4},
+                    })
+
+        return Handler
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubBackend(OpenAIBackend):
+    """
+    OpenAI client talking to a StubLLMServer started in this process
+    """
+
+    name = "stub"
+    cacheable = False
+
+    def __init__(self, server=None, **server_kwargs):
+        self.server = server or StubLLMServer(**server_kwargs).start()
+        super().__init__(api_key="stub", base_url=self.server.base_url)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_llm_backend():
+    """
+    Process-wide backend used by all GPT call sites, chosen by SMART_GATHER_LLM_BACKEND:
+    "openai" (default), "stub" (local stub server) or "replay" (responses recorded in
+    SMART_GATHER_LLM_REPLAY_FILE, recording misses from OpenAI). SMART_GATHER_LLM_LATENCY
+    adds latency to the stand-ins.
+    """
+
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            kind = os.environ.get(LLM_BACKEND_ENV, 'openai')
+            latency = float(os.environ.get(LLM_LATENCY_ENV) or 0)
+            if kind == 'openai':
+                _backend = OpenAIBackend()
+            elif kind == 'stub':
+                _backend = StubBackend(latency=latency)
+            elif kind == 'replay':
+                _backend = ReplayBackend(os.environ.get(LLM_REPLAY_FILE_ENV, 'llm_replay.json'), fallback=OpenAIBackend(), latency=latency)
+            else:
+                raise ValueError(f"unknown LLM backend {kind}")
+        return _backend
+
+
+def set_llm_backend(backend):
+    """
+    Send all GPT requests to `backend` (None goes back to the environment's choice)
+    """
+
+    global _backend
+    with _backend_lock:
+        _backend = backend
+    return backend
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from table_metadata import get_cache_dir, parse_bytes
+
+LLM_CACHE_ENV = "SMART_GATHER_LLM_CACHE"  # set to 0 to always call the API
+LLM_CACHE_TTL_ENV = "SMART_GATHER_LLM_CACHE_TTL"  # seconds an entry stays valid
+LLM_CACHE_SIZE_ENV = "SMART_GATHER_LLM_CACHE_SIZE"  # e.g. "256M"
+
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+
+def request_key(model, messages, temperature, max_tokens):
+    """
+    Content address of a chat completion request
+    """
+
+    request = {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    Disk-backed cache of chat completion responses, one JSON file per request hash.
+    Entries older than `ttl_seconds` are treated as misses, and once the cache grows
+    past `max_bytes` the least recently used entries are evicted.
+
+    Fields:
+        cache_dir: directory the entries are stored in
+        ttl_seconds: how long an entry stays valid (None means forever)
+        max_bytes: size the cache is trimmed to (None means unlimited)
+        hits, misses, expired, evictions: counters since the cache was created
+    """
+
+    def __init__(self, cache_dir=None, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or get_cache_dir('llm')
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = parse_bytes(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self._used_bytes = None  # computed on the first write
+        self._lock = threading.RLock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        """
+        Cached response content for `key`, or None
+        """
+
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+            if self.ttl_seconds is not None and time.time() - entry['created'] > self.ttl_seconds:
+                self._remove(path)
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            os.utime(path)  # mtime orders entries for eviction
+            self.hits += 1
+            return entry['content']
+
+    def put(self, key, content, model=None):
+        with self._lock:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._remove(path)
+
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'model': model, 'created': time.time(), 'content': content}, f)
+            os.replace(tmp_path, path)
+
+            self._scan()
+            self._used_bytes += os.path.getsize(path)
+            self._enforce_size()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    yield os.path.join(root, name)
+
+    def _scan(self):
+        if self._used_bytes is None:
+            self._used_bytes = sum(os.path.getsize(path) for path in self._entries())
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        if self._used_bytes is not None:
+            self._used_bytes -= size
+
+    def _enforce_size(self):
+        if self.max_bytes is None or self._used_bytes <= self.max_bytes:
+            return
+        for path in sorted(self._entries(), key=os.path.getmtime):  # least recently used first
+            if self._used_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._entries()):
+                self._remove(path)
+            self._used_bytes = 0
+
+    def stats(self):
+        """
+        Hit metrics and size of the cache
+        """
+
+        with self._lock:
+            self._scan()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'bytes': self._used_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    Process-wide response cache shared by all GPT call sites, configured from the
+    SMART_GATHER_LLM_CACHE, SMART_GATHER_LLM_CACHE_TTL and SMART_GATHER_LLM_CACHE_SIZE
+    environment variables. Returns None if caching is disabled.
+    """
+
+    global _cache
+    if os.environ.get(LLM_CACHE_ENV, '1') == '0':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            ttl = os.environ.get(LLM_CACHE_TTL_ENV)
+            _cache = LLMResponseCache(
+                ttl_seconds=float(ttl) if ttl else DEFAULT_TTL_SECONDS,
+                max_bytes=os.environ.get(LLM_CACHE_SIZE_ENV) or DEFAULT_MAX_BYTES,
+            )
+        return _cache
+
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import random
+import time
+
+from llm_backend import get_llm_backend
+from llm_cache import get_llm_cache, request_key
+
+LLM_CONCURRENCY_ENV = "SMART_GATHER_LLM_CONCURRENCY"  # max requests in flight
+LLM_TPM_ENV = "SMART_GATHER_LLM_TPM"  # tokens per minute the account allows
+
+DEFAULT_CONCURRENCY = 8
+CHARS_PER_TOKEN = 4  # rough estimate for English text
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """
+    Tokens a request counts against the rate limit: the prompt plus the
+    completion tokens it reserves
+    """
+
+    prompt_chars = sum(len(message['content']) for message in messages)
+    return prompt_chars // CHARS_PER_TOKEN + 1 + (max_tokens or 0)
+
+
+class TokenRateLimiter:
+    """
+    Token bucket allowing `tokens_per_minute` tokens a minute, with bursts up to a
+    minute's worth
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self._available = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.tokens_per_minute, self._available + (now - self._updated) * self.tokens_per_minute / 60)
+        self._updated = now
+
+    async def acquire(self, tokens):
+        # a request bigger than the bucket waits for a full bucket rather than forever
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:  # first come, first served
+            self._refill()
+            while self._available < tokens:
+                await asyncio.sleep((tokens - self._available) * 60 / self.tokens_per_minute)
+                self._refill()
+            self._available -= tokens
+
+
+def _is_retryable(exc):
+    status = getattr(exc, 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # connection errors and timeouts carry no status
+    return type(exc).__name__ in ('APIConnectionError', 'APITimeoutError', 'TimeoutError', 'ConnectionError')
+
+
+def _retry_after(exc):
+    response = getattr(exc, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def cached_chat_completion(model, messages, temperature=0, max_tokens=None, cache=None, backend=None):
+    """
+    Content of the chat completion for the request, served from the response cache
+    when the same request was made before. Only deterministic (temperature 0)
+    requests to cacheable backends are cached.
+    """
+
+    backend = backend or get_llm_backend()
+    cache = cache or get_llm_cache()
+    key = None
+    if cache is not None and backend.cacheable and temperature == 0:
+        key = request_key(model, messages, temperature, max_tokens)
+        content = cache.get(key)
+        if content is not None:
+            return content
+
+    content = backend.complete(model, messages, temperature, max_tokens)
+
+    if key is not None and content is not None:
+        cache.put(key, content, model=model)
+    return content
+
+
+class AsyncLLMClient:
+    """
+    Runs chat completion requests concurrently, with at most `max_concurrency` in
+    flight and (optionally) no more than `tokens_per_minute` tokens sent a minute.
+    Rate-limited (429), server (5xx) and connection errors are retried up to
+    `max_retries` times with exponential backoff and jitter, honouring Retry-After.
+    Responses go through the shared LLM response cache.
+    """
+
+    def __init__(self, backend=None, max_concurrency=None, tokens_per_minute=None, max_retries=5, base_delay=1.0, max_delay=60.0, cache=None):
+        if max_concurrency is None:
+            max_concurrency = int(os.environ.get(LLM_CONCURRENCY_ENV) or DEFAULT_CONCURRENCY)
+        if tokens_per_minute is None and os.environ.get(LLM_TPM_ENV):
+            tokens_per_minute = int(os.environ[LLM_TPM_ENV])
+
+        self.backend = backend or get_llm_backend()
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache or get_llm_cache()
+
+        self.retries = 0
+        self._semaphore = None
+        self._rate_limiter = None
+
+    async def complete(self, model, messages, temperature=0, max_tokens=None):
+        """
+        Content of the chat completion for one request
+        """
+
+        key = None
+        if self.cache is not None and self.backend.cacheable and temperature == 0:
+            key = request_key(model, messages, temperature, max_tokens)
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        # created lazily so they bind to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._rate_limiter is None and self.tokens_per_minute:
+            self._rate_limiter = TokenRateLimiter(self.tokens_per_minute)
+
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self._rate_limiter is not None:
+                    await self._rate_limiter.acquire(estimate_tokens(messages, max_tokens))
+                try:
+                    content = await self.backend.acomplete(model, messages, temperature, max_tokens)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries or not _is_retryable(e):
+                        raise
+                    delay = _retry_after(e)
+                    if delay is None:
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+
+        if key is not None and content is not None:
+            self.cache.put(key, content, model=model)
+        return content
+
+    async def complete_all(self, requests):
+        """
+        Contents of the chat completions for `requests` (dicts of complete()'s
+        arguments), in the same order as the requests
+        """
+
+        return await asyncio.gather(*[self.complete(**request) for request in requests])
+
+
+def run_completions(requests, **kwargs):
+    """
+    Run `requests` concurrently from synchronous code and return their contents in
+    order. Keyword arguments configure the AsyncLLMClient.
+    """
+
+    if len(requests) == 0:
+        return []
+    return asyncio.run(AsyncLLMClient(**kwargs).complete_all(requests))
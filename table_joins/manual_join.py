@@ -1,4 +1,3 @@
-import csv
 import time
 import pandas as pd
 
@@ -15,25 +14,22 @@ parent_directory = os.path.dirname(current_directory)
 sys.path.append(parent_directory)
 
 from multi_table_join import MultiTableJoin
+from table_metadata import get_table_metadata
 from file_processing.utils.glove_col_similarity import *
 
-embedding_space = get_glove_embedding_space()
 
+def get_embedding_space():
+    """
+    GloVe embedding space, loaded on first use rather than at import so runs that
+    never match headers (and `--help`) don't pay for reading it
+    """
 
-def get_headers(filename):
-    sniffer = csv.Sniffer()
-    with open(filename, mode='r', encoding='utf-8-sig') as f:
-        dialect = sniffer.sniff(f.read(1024))
-        f.seek(0)
-        csv_reader = csv.reader(f, delimiter=dialect.delimiter)
-        a = next(csv_reader)
-        f.close()
+    return get_glove_embedding_space()
 
-        # trim whitespace from headers
-        a = [col.strip() for col in a]
-        return a
-        # header = next(csv_reader)[0].split(';')
-        # return header
+
+def get_headers(filename):
+    # headers are sniffed once per file and trimmed of whitespace by the registry
+    return list(get_table_metadata(filename).headers)
 
 
 def join_tables(files_to_matches, intersection, schema_headers, result_filename):
@@ -148,7 +144,7 @@ def get_matches(schema_headers, csv_headers):
     for schema_header in schema_headers:
         matches[schema_header] = {}
         for filename, headers in csv_headers.items():
-            matches[schema_header][filename] = get_schema_header_match(schema_header, headers, embedding_space)
+            matches[schema_header][filename] = get_schema_header_match(schema_header, headers, get_embedding_space())
 
     cols_to_matches = {} # map schema header to (file containing best match, match col name, similarity score)
     for schema_header, match_info in matches.items():
@@ -204,7 +200,7 @@ def plan_join(files, schema_headers, verbose=False):
 
     if len(files_to_matches) > 1:
         subset = {f: csv_headers[f] for f in files_to_matches} # only find intersection for files that contain schema cols
-        plan['intersections'] = find_header_intersection(subset, embedding_space, len(files_to_matches))
+        plan['intersections'] = find_header_intersection(subset, get_embedding_space(), len(files_to_matches))
 
         if verbose:
             print("Intersections:", plan['intersections'])
@@ -0,0 +1,265 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import pandas as pd
+
+from table_metadata import parse_bytes
+
+MEMORY_BUDGET_ENV = "SMART_GATHER_MEMORY_BUDGET"  # e.g. "512M", "4G" or a number of bytes
+SPILL_DIR_ENV = "SMART_GATHER_SPILL_DIR"
+
+
+def frame_size(df):
+    """
+    Number of bytes held by `df`, including the contents of object columns
+    """
+
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def write_frame(df, path_base):
+    """
+    Write `df` to `path_base` as Parquet, falling back to pickle when pyarrow is
+    missing or the frame has columns Parquet can't represent (e.g. mixed types).
+    Returns the path written.
+    """
+
+    try:
+        path = path_base + '.parquet'
+        df.to_parquet(path)
+        return path
+    except Exception:
+        path = path_base + '.pickle'
+        df.to_pickle(path)
+        return path
+
+
+def read_frame(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+class MemoryGovernor:
+    """
+    Accounts for every DataFrame registered with it and, once `budget_bytes` is
+    exceeded, spills the least recently used unpinned frames to local files.
+    Spilled frames are transparently reloaded by get().
+
+    Fields:
+        budget_bytes: memory budget in bytes (None means unlimited)
+        spill_dir: directory spilled frames are written to
+        used_bytes: bytes currently held in memory by registered frames
+        spilled_bytes: total bytes spilled so far
+    """
+
+    def __init__(self, budget_bytes=None, spill_dir=None):
+        self.budget_bytes = parse_bytes(budget_bytes)
+        self.spill_dir = spill_dir
+        self.used_bytes = 0
+        self.spilled_bytes = 0
+
+        self._frames = OrderedDict()  # {key: (df, size)}, least recently used first
+        self._spilled = {}  # {key: spill path}
+        self._pinned = {}  # {key: pin count}
+        self._spill_count = 0
+        self._lock = threading.RLock()
+
+    def _get_spill_dir(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="smart_gather_spill_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return self.spill_dir
+
+    def register(self, key, df):
+        """
+        Account for `df` under `key` (replacing any previous frame) and spill cold
+        frames if this pushes us over budget
+        """
+
+        with self._lock:
+            self.release(key)
+            size = frame_size(df)
+            self._frames[key] = (df, size)
+            self.used_bytes += size
+            self._enforce_budget(protect=key)
+
+    def get(self, key):
+        """
+        Return the frame registered under `key`, reloading it if it was spilled
+        """
+
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key][0]
+
+            path = self._spilled.pop(key)
+            df = read_frame(path)
+            os.remove(path)
+            self.register(key, df)
+            return df
+
+    def remeasure(self, key):
+        """
+        Update the size accounted for the frame under `key` after it was changed in
+        place (e.g. columns renamed or added), spilling cold frames if it grew
+        """
+
+        with self._lock:
+            if key not in self._frames:
+                return
+            df, old_size = self._frames[key]
+            size = frame_size(df)
+            self._frames[key] = (df, size)
+            self.used_bytes += size - old_size
+            self._enforce_budget(protect=key)
+
+    def release(self, key):
+        """
+        Forget the frame under `key`, in memory or spilled
+        """
+
+        with self._lock:
+            if key in self._frames:
+                _, size = self._frames.pop(key)
+                self.used_bytes -= size
+            if key in self._spilled:
+                path = self._spilled.pop(key)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def pin(self, key):
+        """
+        Keep the frame under `key` in memory until unpin() is called
+        """
+
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self._lock:
+            if self._pinned.get(key, 0) <= 1:
+                self._pinned.pop(key, None)
+            else:
+                self._pinned[key] -= 1
+            self._enforce_budget()
+
+    def is_spilled(self, key):
+        return key in self._spilled
+
+    def __contains__(self, key):
+        return key in self._frames or key in self._spilled
+
+    def keys(self):
+        with self._lock:
+            return list(self._frames.keys()) + list(self._spilled.keys())
+
+    def _enforce_budget(self, protect=None):
+        if self.budget_bytes is None:
+            return
+
+        for key in list(self._frames.keys()):  # coldest first
+            if self.used_bytes <= self.budget_bytes:
+                break
+            if key == protect or key in self._pinned:
+                continue
+            self._spill(key)
+
+    def _spill(self, key):
+        df, size = self._frames.pop(key)
+        self._spill_count += 1
+        path_base = os.path.join(self._get_spill_dir(), f"frame_{os.getpid()}_{self._spill_count}")
+        self._spilled[key] = write_frame(df, path_base)
+        self.used_bytes -= size
+        self.spilled_bytes += size
+
+
+class GovernedFrames(MutableMapping):
+    """
+    dict-like view of the frames a single owner (e.g. one MultiTableJoin) has
+    registered with a MemoryGovernor. Keys are namespaced by the owner so several
+    joins can share one governor.
+    """
+
+    def __init__(self, governor, owner):
+        self.governor = governor
+        self.owner = owner
+        self._keys = set()
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return self.governor.get((self.owner, key))
+
+    def __setitem__(self, key, df):
+        self.governor.register((self.owner, key), df)
+        self._keys.add(key)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self.governor.release((self.owner, key))
+        self._keys.remove(key)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def pin(self, key):
+        self.governor.pin((self.owner, key))
+
+    def remeasure(self, key):
+        self.governor.remeasure((self.owner, key))
+
+    def unpin(self, key):
+        self.governor.unpin((self.owner, key))
+
+    def clear(self):
+        for key in list(self._keys):
+            del self[key]
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_memory_governor():
+    """
+    Process-wide governor shared by all joins, configured from the
+    SMART_GATHER_MEMORY_BUDGET and SMART_GATHER_SPILL_DIR environment variables
+    """
+
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = MemoryGovernor(os.environ.get(MEMORY_BUDGET_ENV), os.environ.get(SPILL_DIR_ENV))
+        return _governor
+
+
+def set_memory_budget(budget_bytes, spill_dir=None):
+    """
+    Change the budget of the process-wide governor, spilling immediately if needed
+    """
+
+    governor = get_memory_governor()
+    with governor._lock:
+        governor.budget_bytes = parse_bytes(budget_bytes)
+        if spill_dir is not None:
+            governor.spill_dir = spill_dir
+        governor._enforce_budget()
+    return governor
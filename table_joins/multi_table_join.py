@@ -1,14 +1,29 @@
-import csv
+import uuid
 import pandas as pd
 
+from csv_helpers import read_csv
+from join_explain import ExplainNode, StepTimer, file_size
+from memory_governor import GovernedFrames, get_memory_governor
+
+INTERMEDIATE_RESULT = '__result__'  # key of the running join result in self.dfs
+
 class MultiTableJoin:
-	def __init__(self, intersections_to_join_cols, schema_headers, files_to_cols = None):
+	def __init__(self, intersections_to_join_cols, schema_headers, files_to_cols = None, memory_governor = None, rank_join_cols = True, dtypes = None):
 		"""Initializes a MultiTableJoin object
 
 		Args:
 			intersections_to_join_cols (dict): {intersection: (col_1, col_2)}
 
 			files_to_cols (dict): {file: [(col_1, schema_col_1), (col_2, schema_col_2), ...]}
+
+			memory_governor (MemoryGovernor): accounts for loaded frames and spills cold
+				ones to disk when over budget; defaults to the process-wide governor
+
+			rank_join_cols (bool): if False, join on exactly the given columns instead of
+				picking the (up to 2) candidates with the largest join cardinality
+
+			dtypes (dict): {file: {col: dtype}} to parse columns with, e.g. from
+				csv_helpers.get_read_dtypes
 		"""
 		# create a dictionary {file: {other_file: (col_1, col_2)}}
 		intersections = {}
@@ -41,22 +56,31 @@ class MultiTableJoin:
 			self.projections = projections
 
 		self.schema_headers = schema_headers
+		self.rank_join_cols = rank_join_cols
+		self.dtypes = dtypes or {}
+		self.chosen_join_cols = {}  # {(file, other_file): [(col_1, col_2, similarity)]} used by get_result
 
-		self.dfs = {}
+		# loaded frames, accounted for (and spilled when over budget) by the governor
+		self.dfs = GovernedFrames(memory_governor or get_memory_governor(), uuid.uuid4().hex)
 		self.result = None
+		self.explain_tree = None  # ExplainNode describing the last get_result run
+		self._trace_memory = False
+		self._pinned_frames = set()  # keys in self.dfs get_result holds references to
 		self.column_to_new_name = {}  # {file: {col: new_col_name}} to deal with duplicate column names
 
 	def get_df(self, filename, can_create = True) -> pd.DataFrame:
 		if filename not in self.dfs:
 			if can_create:
-				sniffer = csv.Sniffer()
-				with open(filename, 'r', encoding='utf-8-sig') as f:
-					dialect = sniffer.sniff(f.read(1024))
-				f.close()
-				df = pd.read_csv(filename, sep=dialect.delimiter)
-
-				# trim whitespace from headers
-				df.columns = [col.strip() for col in df.columns]
+				load_node = None
+				if self.explain_tree is not None:
+					load_node = self.explain_tree.add_child(f"load {filename}", bytes_read=file_size(filename))
+
+				with StepTimer(load_node, self._trace_memory):
+					df = read_csv(filename, dtype=self.dtypes.get(filename))
+
+				if load_node is not None:
+					load_node.info['rows'] = len(df)
+					load_node.info['columns'] = len(df.columns)
 				# # remove unneeded columns  NOTE: will break multi column joins in its current form
 				# if self.projections is not None:
 				# 	for col in df.columns:
@@ -73,6 +97,13 @@ class MultiTableJoin:
 				return None
 		return self.dfs[filename]
 
+	def set_df(self, filename, df):
+		"""
+		Use an already loaded frame for `filename` instead of reading the file
+		"""
+		df.columns = [col.strip() for col in df.columns]
+		self.dfs[filename] = df
+
 	def get_table_name(self, filename):
 		return filename.split('/')[-1].split('.')[0]
 
@@ -89,7 +120,52 @@ class MultiTableJoin:
 			self.column_to_new_name[filename][col] = new_col_name
 			df.rename(columns={col: new_col_name}, inplace=True)
 
-	def get_result(self, write_to_file_name=None, limit_rows=None, verbose=False) -> pd.DataFrame:
+	def pin_frame(self, key):
+		"""
+		Keep the frame under `key` in memory while get_result refers to it, since
+		spilling it then would write a copy without freeing anything
+		"""
+		if key not in self._pinned_frames:
+			self.dfs.pin(key)
+			self._pinned_frames.add(key)
+
+	def unpin_frame(self, key):
+		if key in self._pinned_frames:
+			self._pinned_frames.remove(key)
+			self.dfs.unpin(key)
+
+	def release_intermediate(self):
+		"""
+		Stop accounting for the running join result once get_result is done with it
+		"""
+		for key in list(self._pinned_frames):
+			self.unpin_frame(key)
+		if INTERMEDIATE_RESULT in self.dfs:
+			del self.dfs[INTERMEDIATE_RESULT]
+
+	def explain(self, format='text', limit_rows=None):
+		"""
+		Return an EXPLAIN ANALYZE report of the join: the plan, the candidate join
+		columns with their cardinalities, and per-step row counts, wall time, peak
+		memory and bytes read per file. Runs the join (tracing memory) if it has
+		not been run yet, without writing the result anywhere.
+
+		A join is only run once, so call explain() (or get_result(explain=True))
+		before get_result() to get peak memory figures; the report of a join run
+		without tracing says so instead.
+
+		Args:
+			format (str): "text" or "json"
+		"""
+		if self.explain_tree is None:
+			self.get_result(limit_rows=limit_rows, explain=True)
+		return self.explain_tree.render(format)
+
+	def get_result(self, write_to_file_name=None, limit_rows=None, verbose=False, explain=False) -> pd.DataFrame:
+		"""
+		Join all files and project the result onto the schema headers. If `explain`
+		is set, also trace peak memory per step for `self.explain_tree`.
+		"""
 		if isinstance(self.result, str):
 			print(self.result)
 			return None
@@ -107,6 +183,18 @@ class MultiTableJoin:
 
 		expected_num_files = len(self.intersections)
 
+		self._trace_memory = explain
+		root = ExplainNode(
+			"MultiTableJoin",
+			plan={file: {other: join_cols for other, join_cols in others.items()} for file, others in self.intersections.items()},
+			projections=self.projections,
+		)
+		if not explain:
+			root.info['peak_memory'] = "not traced (call explain() before get_result())"
+		self.explain_tree = root
+		root_timer = StepTimer(root, explain)
+		root_timer.start()
+
 		all_files = list(self.intersections.keys())
 		for file in all_files:
 			if file not in self.intersections:  # already finished all joins for this file
@@ -117,12 +205,18 @@ class MultiTableJoin:
 				seen_files.add(file)
 				seen_columns.append((file, result.columns))
 
+				# until the first merge the running result is this file's own frame,
+				# which is already accounted for, so just keep it in memory
+				self.pin_frame(file)
+				result_key = file
+
 			if file not in seen_files:
 				continue
 
 			other_files = list(self.intersections[file].keys())
 			for other_file in other_files:
 				other_df = self.get_df(other_file)
+				self.pin_frame(other_file)
 
 				# check for duplicate column names
 				if other_file not in seen_files:
@@ -136,9 +230,17 @@ class MultiTableJoin:
 							self.distinguish_column_name(other_file, schema_headers, other_df)
 
 					seen_columns.append((other_file, other_df.columns))
+					# renamed in place, so the governor's sizes need updating
+					self.dfs.remeasure(result_key)
+					self.dfs.remeasure(other_file)
 
 				# join the two tables
 				join_cols = self.intersections[file][other_file]
+				step = root.add_child(f"join {file} and {other_file}")
+				step_timer = StepTimer(step, explain)
+				step_timer.start()
+				candidates = []
+				step.info['candidates'] = candidates
 
 				if isinstance(join_cols, tuple):  # single column join
 					join_cols = [join_cols]
@@ -148,13 +250,17 @@ class MultiTableJoin:
 				# rank the join columns by cardinality
 				i = 0
 				cols_ranked = []
-				while i < len(left_cols):
+				while self.rank_join_cols and i < len(left_cols):
 					# switch result and other_df if the join is backwards
 					if left_cols[i] not in result.columns:
 						result, other_df = other_df, result
 
+					candidate = {'left': left_cols[i], 'right': right_cols[i], 'similarity': join_cols[i][2]}
+					candidates.append(candidate)
+
 					# skip if column types don't match
 					if result[left_cols[i]].dtype != other_df[right_cols[i]].dtype:
+						candidate['skipped'] = f"dtype mismatch ({result[left_cols[i]].dtype} vs {other_df[right_cols[i]].dtype})"
 						i += 1
 						continue
 
@@ -164,30 +270,39 @@ class MultiTableJoin:
 
 					# find the number of rows in the join
 					card = len(left_df.merge(right_df, left_on=[left_cols[i]], right_on=[right_cols[i]], how='inner'))
+					candidate['cardinality'] = card
 
 					if card > 0:
 						cols_ranked.append((card, i))
 
 					i += 1
 
-				# if no columns on which to join, fail
-				if len(cols_ranked) == 0:
-					error = f"ERROR: no columns on which to join {file} and {other_file}"
-					print(error)
-					self.result = error
-					return None
-
-				# choose up to 2 columns to join on, ranked by length of resulting dataframe
-				cols_ranked = [jc[1] for jc in sorted(
-					cols_ranked,
-					key=lambda col: (col[0], join_cols[col[1]][2]),
-					reverse=True
-				)]
-				if len(cols_ranked) > 2:
-					cols_ranked = cols_ranked[:2]
+				if not self.rank_join_cols:
+					cols_ranked = list(range(len(join_cols)))
+				else:
+					# if no columns on which to join, fail
+					if len(cols_ranked) == 0:
+						error = f"ERROR: no columns on which to join {file} and {other_file}"
+						print(error)
+						self.result = error
+						step.info['error'] = error
+						step_timer.stop()
+						root_timer.stop()
+						self.release_intermediate()
+						return None
+
+					# choose up to 2 columns to join on, ranked by length of resulting dataframe
+					cols_ranked = [jc[1] for jc in sorted(
+						cols_ranked,
+						key=lambda col: (col[0], join_cols[col[1]][2]),
+						reverse=True
+					)]
+					if len(cols_ranked) > 2:
+						cols_ranked = cols_ranked[:2]
 
 				left_cols = [jc for i, jc in enumerate(left_cols) if i in cols_ranked]
 				right_cols = [jc for i, jc in enumerate(right_cols) if i in cols_ranked]
+				self.chosen_join_cols[(file, other_file)] = [jc for i, jc in enumerate(join_cols) if i in cols_ranked]
 
 				if verbose:
 					print("joining", file, "and", other_file, "on", left_cols, "and", right_cols)
@@ -197,7 +312,20 @@ class MultiTableJoin:
 				if left_cols[0] not in result.columns:
 					result, other_df = other_df, result
 				# do the join
+				step.info['chosen'] = {'left': left_cols, 'right': right_cols}
+				step.info['input_rows'] = {'left': len(result), 'right': len(other_df)}
 				result = result.merge(other_df, left_on=left_cols, right_on=right_cols, how='inner')
+				step.info['output_rows'] = len(result)
+				other_df = None  # so the input frames can be spilled
+
+				# keep the running result in memory while we're joining into it
+				self.dfs[INTERMEDIATE_RESULT] = result
+				self.pin_frame(INTERMEDIATE_RESULT)
+				if result_key != INTERMEDIATE_RESULT:
+					self.unpin_frame(result_key)
+					result_key = INTERMEDIATE_RESULT
+				self.unpin_frame(other_file)
+				step_timer.stop()
 
 				seen_files.add(other_file)
 
@@ -216,14 +344,21 @@ class MultiTableJoin:
 			print("expected files:", all_files)
 
 			self.result = "ERROR: joins did not form a connected graph"
+			root.info['error'] = self.result
+			root_timer.stop()
+			self.release_intermediate()
 			return None
 
 		# project the result
+		project = root.add_child("project and deduplicate", input_rows=len(result))
+		project_timer = StepTimer(project, explain)
+		project_timer.start()
 		if self.projections is not None:
 			for file in self.projections:
 				for col, schema_headers in self.projections[file].items():
 					for schema_col in schema_headers:
 						result[schema_col] = result[self.get_current_column_name(file, col)]
+			self.dfs.remeasure(result_key)  # grew in place
 
 			result = result[self.schema_headers]
 
@@ -232,6 +367,11 @@ class MultiTableJoin:
 		if limit_rows is not None and len(result) > limit_rows:
 			self.result = self.result[:limit_rows]
 
+		self.release_intermediate()
+		project.info['output_rows'] = len(self.result)
+		project_timer.stop()
+		root.info['output_rows'] = len(self.result)
+		root_timer.stop()
 
 		if write_to_file_name is not None:
 			self.result.to_csv(write_to_file_name, index=False)
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def _canonical(col):
+    # string form of each value with integral floats written as ints and missing
+    # values as None, so 1 parsed as int64 and 1.0 parsed as float64 are the same
+    text = col.astype(str).astype(object)
+    if pd.api.types.is_float_dtype(col):
+        values = col.to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            integral = np.isfinite(values) & (values == np.trunc(values)) & (np.abs(values) < 2 ** 63)
+        text[integral] = [str(v) for v in values[integral].astype(np.int64)]
+    text[col.isna().to_numpy()] = None
+    return text
+
+
+def hash_rows(df):
+    """
+    64-bit hash of each row of `df` (the index is ignored), computed from the
+    rows' values rather than their dtypes, so rows compare equal regardless of the
+    dtypes pandas happened to infer for a batch
+    """
+
+    canonical = pd.DataFrame({i: _canonical(df.iloc[:, i]) for i in range(df.shape[1])}, index=df.index)
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy(dtype=np.uint64)
+
+
+def runs_contain(runs, hashes):
+    """
+    Mask of the `hashes` found in any of `runs` (sorted uint64 arrays, which may be
+    memory-mapped)
+    """
+
+    found = np.zeros(len(hashes), dtype=bool)
+    for run in runs:
+        if len(run) == 0:
+            continue
+        idx = np.searchsorted(run, hashes)
+        idx[idx == len(run)] = 0
+        found |= np.asarray(run[idx]) == hashes
+    return found
+
+
+class RowHashSet:
+    """
+    Set of 64-bit row hashes with bounded memory. Up to `max_in_memory` hashes are
+    kept in a sorted in-memory array; beyond that the array is written out as a
+    sorted run and memory-mapped, so lookups stay O(log n) per run while resident
+    memory stays bounded.
+
+    Distinct rows sharing a 64-bit hash are treated as duplicates (probability
+    ~n^2 / 2^65 for n rows).
+    """
+
+    def __init__(self, max_in_memory=1_000_000, spill_dir=None):
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir
+        self.size = 0
+
+        self._memory = np.empty(0, dtype=np.uint64)
+        self._runs = []  # memory-mapped sorted arrays
+        self._run_paths = []
+        self._owns_spill_dir = False
+
+    def _contains(self, hashes):
+        return runs_contain([self._memory] + self._runs, hashes)
+
+    def add_new(self, hashes):
+        """
+        Add `hashes` to the set. Returns a mask marking the hashes that were not
+        already in the set (only the first occurrence of a repeated hash is marked).
+        """
+
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        is_new = np.zeros(len(hashes), dtype=bool)
+        _, first = np.unique(hashes, return_index=True)
+        is_new[first] = True
+        is_new[is_new] = ~self._contains(hashes[is_new])
+
+        added = hashes[is_new]
+        self.size += len(added)
+        self._memory = np.union1d(self._memory, added)
+        if len(self._memory) > self.max_in_memory:
+            self._spill()
+
+        return is_new
+
+    def _spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="smart_gather_hashes_")
+            self._owns_spill_dir = True
+        path = os.path.join(self.spill_dir, f"run_{len(self._runs)}.npy")
+        np.save(path, self._memory)
+        self._runs.append(np.load(path, mmap_mode='r'))
+        self._run_paths.append(path)
+        self._memory = np.empty(0, dtype=np.uint64)
+
+    def close(self):
+        """
+        Delete any spilled runs, and the spill directory if it was created here
+        """
+
+        self._runs = []
+        for path in self._run_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self._run_paths = []
+        if self._owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self._owns_spill_dir = False
+
+    def __len__(self):
+        return self.size
@@ -1,13 +1,17 @@
-import csv
 import pandas as pd
 
+from csv_helpers import read_csv
+from row_hash_set import RowHashSet, hash_rows
+
 class SingleTableFilter:
-    def __init__(self, file_mapping, schema_headers):
+    def __init__(self, file_mapping, schema_headers, dtypes=None):
         """Initializes a SingleTableFilter object
 
         Args:
             file_mapping (dict): {filename : [(file_col, schema_col), ...]}
             schema_headers (list): list of requested headers for schema
+            dtypes (dict): {filename: {file_col: dtype}} to parse columns with, e.g.
+                from csv_helpers.get_read_dtypes
         """
 
         assert(len(file_mapping) == 1)
@@ -19,39 +23,38 @@ class SingleTableFilter:
         for f_col, s_col in file_mapping[self.filename]:
             self.headers[f_col] = self.headers.get(f_col, []) + [s_col]
 
-        self.get_df()
+        self.dtypes = (dtypes or {}).get(self.filename)
+        self.df = None  # loaded lazily by get_result
+
+    def _read_csv(self, **kwargs):
+        # only parse the columns the schema asks for
+        return read_csv(self.filename, usecols=lambda col: col.strip() in self.headers, dtype=self.dtypes, **kwargs)
 
     def get_df(self) -> pd.DataFrame:
         """
-        Create raw df from csv file
+        Create raw df of the mapped columns from csv file
         """
 
-        sniffer = csv.Sniffer()
-        with open(self.filename, 'r', encoding='utf-8-sig') as f:
-            dialect = sniffer.sniff(f.read(1024))
-        f.close()
-        df = pd.read_csv(self.filename, sep=dialect.delimiter)
-
-        # trim whitespace from headers
-        df.columns = [col.strip() for col in df.columns]
-        self.df = df
+        self.df = self._read_csv()
 
         headers = self.df.columns.tolist()
 
         return self.df
 
-    def _replace_col(self, row) -> None:
+    def _project(self, df) -> pd.DataFrame:
         """
-        Given a row of the input file df, create a dict mapping its values into
-        the schema format
+        Select the mapped file columns and alias them to their schema names. A file
+        column is only copied when it feeds more than one schema column.
         """
 
-        new_row = {}
-        for file_col, schema_cols in self.headers.items():
-            for schema_col in schema_cols:
-                new_row[schema_col] = row[file_col]
+        file_cols = list(self.headers.keys())
+        projection = df[file_cols].set_axis([self.headers[f_col][0] for f_col in file_cols], axis=1)
+
+        for schema_cols in self.headers.values():
+            for schema_col in schema_cols[1:]:
+                projection[schema_col] = projection[schema_cols[0]]
 
-        return new_row
+        return projection[self.schema_headers]
 
     def get_result(self, write_to_file_name=None, limit_rows=None, verbose=False) -> pd.DataFrame:
         """
@@ -59,12 +62,10 @@ class SingleTableFilter:
         `limit_rows` rows if specified by `write_to_file_name`.
         """
 
-        self.df = pd.DataFrame(self.df.apply(self._replace_col, axis=1).tolist())
+        if self.df is None:
+            self.get_df()
 
-        headers = self.df.columns.tolist()
-
-        self.result = self.df.drop_duplicates()
-        self.result = self.result[self.schema_headers]
+        self.result = self._project(self.df).drop_duplicates()
 
         if limit_rows is not None and len(self.result) > limit_rows:
             self.result = self.result[:limit_rows]
@@ -74,3 +75,37 @@ class SingleTableFilter:
             self.result.to_csv(write_to_file_name, index=False)
 
         return self.result
+
+    def stream_result(self, write_to_file_name, limit_rows=None, chunksize=100_000, max_hashes_in_memory=1_000_000, verbose=False) -> int:
+        """
+        Streaming version of get_result for files that don't fit in memory: read the
+        file `chunksize` rows at a time, project each chunk onto the schema headers,
+        drop rows already seen in earlier chunks (tracked as row hashes, spilled to
+        disk beyond `max_hashes_in_memory`) and append the rest to
+        `write_to_file_name`. Returns the number of rows written.
+        """
+
+        seen = RowHashSet(max_in_memory=max_hashes_in_memory)
+        rows_written = 0
+
+        try:
+            for chunk in self._read_csv(chunksize=chunksize):
+                chunk.columns = [col.strip() for col in chunk.columns]
+                chunk = self._project(chunk)
+                chunk = chunk[seen.add_new(hash_rows(chunk))]
+
+                if limit_rows is not None and rows_written + len(chunk) > limit_rows:
+                    chunk = chunk[:limit_rows - rows_written]
+
+                chunk.to_csv(write_to_file_name, mode='w' if rows_written == 0 else 'a', header=rows_written == 0, index=False)
+                rows_written += len(chunk)
+
+                if verbose:
+                    print(f"wrote {rows_written} rows to {write_to_file_name} ({len(seen)} distinct rows seen)")
+
+                if limit_rows is not None and rows_written >= limit_rows:
+                    break
+        finally:
+            seen.close()
+
+        return rows_written
@@ -0,0 +1,438 @@
+import bz2
+import codecs
+import csv
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import threading
+import zipfile
+
+CACHE_DIR_ENV = "SMART_GATHER_CACHE_DIR"
+METADATA_CACHE_FILE = "table_metadata.json"
+
+SNIFF_BYTES = 1024  # what the readers have always handed to csv.Sniffer
+PEEK_BYTES = 64 * 1024  # header, row-size estimate and fingerprint sample
+
+OVERLAY_SUFFIX = ".overlay.json"  # header overlay sidecar, named after the table it defines
+
+# compression formats we read directly, by file suffix and by magic bytes
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd', '.zip': 'zip'}
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'PK\x03\x04', 'zip'),
+]
+
+
+def detect_compression(name, head=b''):
+    """
+    Compression of a file (or URL) from its suffix, else from its first bytes.
+    Returns None for uncompressed data.
+    """
+
+    path = name.split('?', 1)[0].lower()
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _first_member(archive):
+    # like pd.read_csv, a zip archive holds a single csv
+    members = [info for info in archive.infolist() if not info.is_dir()]
+    if len(members) == 0:
+        raise ValueError(f"no files in zip archive {archive.filename}")
+    return members[0]
+
+
+def open_binary(source, compression=None):
+    """
+    Open a path or binary file object as a stream of decompressed bytes. Data is
+    decompressed as it is read, so peeking at the start only inflates the first block.
+    """
+
+    fileobj = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+    if compression is None:
+        return fileobj
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("reading .zst files requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    if compression == 'zip':
+        archive = zipfile.ZipFile(fileobj)
+        return archive.open(_first_member(archive))
+    raise ValueError(f"unknown compression {compression}")
+
+
+def _inflate_head(source, compression, n=PEEK_BYTES, block_size=4096):
+    """
+    Decompress just enough of a path or binary file object to get its first `n`
+    bytes. Returns them with the compression ratio of the blocks inflated.
+    """
+
+    if compression == 'gzip':
+        import zlib
+        decompressor = zlib.decompressobj(wbits=31)
+    elif compression == 'bz2':
+        decompressor = bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        decompressor = lzma.LZMADecompressor()
+    elif compression == 'zstd':
+        import zstandard
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError(f"unknown compression {compression}")
+
+    head, consumed = b'', 0
+    with open_binary(source) as f:
+        while len(head) < n:
+            block = f.read(block_size)
+            if not block:
+                break
+            consumed += len(block)
+            try:
+                head += decompressor.decompress(block)
+            except EOFError:
+                break  # end of the first gzip member / bz2 stream
+            if getattr(decompressor, 'eof', False):
+                break
+    return head[:n], len(head) / max(consumed, 1)
+
+
+def read_header_overlay(path):
+    """
+    The header overlay defining the table at `path`, as {"source": absolute path of
+    the csv it reads from, "header": replacement first line}. Returns None if `path`
+    is a real file or has no overlay.
+    """
+
+    sidecar = path + OVERLAY_SUFFIX
+    if os.path.exists(path) or not os.path.exists(sidecar):
+        return None
+    with open(sidecar, 'r', encoding='utf-8') as f:
+        overlay = json.load(f)
+    overlay['source'] = os.path.join(os.path.dirname(os.path.abspath(path)), overlay['source'])
+    return overlay
+
+
+def write_header_overlay(path, source, header):
+    """
+    Define the table at `path` as the csv `source` with its first line replaced by
+    `header`. Only a small JSON sidecar is written next to `source`; every reader
+    going through open_table or read_csv sees the replaced header.
+    """
+
+    if os.path.abspath(path) == os.path.abspath(source):
+        raise ValueError(f"header overlay {path} would shadow its own source")
+    if os.path.exists(path):
+        os.remove(path)  # a stale full copy would take precedence over the overlay
+    overlay = {
+        'source': os.path.relpath(os.path.abspath(source), os.path.dirname(os.path.abspath(path))),
+        'header': header.rstrip('\r\n'),
+    }
+    with open(path + OVERLAY_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump(overlay, f, indent=4)
+    _registry.invalidate(path)
+    return path
+
+
+class _HeaderOverlayReader(io.RawIOBase):
+    """
+    Seekable byte stream of `header` followed by `body` from offset `body_start`
+    (the end of the body's own header line) on
+    """
+
+    def __init__(self, header, body, body_start):
+        self.header = header
+        self.body = body
+        self.body_start = body_start
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.body.seekable()
+
+    def readinto(self, b):
+        if self._pos < len(self.header):
+            data = self.header[self._pos:self._pos + len(b)]
+        else:
+            data = self.body.read(len(b))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self.header) + self.body.seek(0, io.SEEK_END) - self.body_start
+        self._pos = offset
+        self.body.seek(self.body_start + max(0, offset - len(self.header)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self.body.close()
+        super().close()
+
+
+def open_table(path):
+    """
+    Open the csv at `path` as a stream of decompressed bytes, honouring header overlays
+    """
+
+    meta = get_table_metadata(path)
+    if meta.overlay is None:
+        return open_binary(path, meta.compression)
+
+    overlay = read_header_overlay(path)
+    body = open_binary(overlay['source'], meta.compression)
+    body.readline()
+    header = (overlay['header'] + '\n').encode('utf-8')
+    return io.BufferedReader(_HeaderOverlayReader(header, body, body.tell()))
+
+
+def peek(source, n=PEEK_BYTES, compression=None):
+    """
+    First `n` decompressed bytes of a path or binary file object
+    """
+
+    with open_binary(source, compression) as f:
+        return f.read(n)
+
+
+def peek_prefix(data, compression=None, n=PEEK_BYTES):
+    """
+    First `n` decompressed bytes of `data`, the start of a file that may be cut off
+    (e.g. the first bytes of a download). Zip archives keep their directory at the
+    end, so a cut-off archive raises zipfile.BadZipFile.
+    """
+
+    if compression is None:
+        return data[:n]
+    if compression == 'zip':
+        return peek(io.BytesIO(data), n, compression)
+    return _inflate_head(io.BytesIO(data), compression, n)[0]
+
+
+def parse_bytes(value):
+    """
+    Parse a byte count such as 1048576, "512K", "64M" or "2G"
+    """
+
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def get_cache_dir(*subdirs):
+    """
+    Root of the on-disk caches ($SMART_GATHER_CACHE_DIR, or ~/.cache/smart_gather),
+    creating `subdirs` under it
+    """
+
+    root = os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".cache", "smart_gather")
+    path = os.path.join(root, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class TableMetadata:
+    """
+    What we know about a csv file without parsing it.
+
+    Fields:
+        path: absolute path of the file
+        delimiter: delimiter detected by csv.Sniffer
+        encoding: "utf-8-sig" if the file starts with a BOM, else "utf-8"
+        compression: compression of the file ("gzip", "zstd", "zip", ...) or None
+        overlay: header overlay sidecar defining the table (see write_header_overlay) or None
+        headers: header row with whitespace trimmed from each column name
+        row_count_estimate: number of data rows, extrapolated from the first block
+        size: file size in bytes (compressed size for compressed files, source size for overlays)
+        mtime_ns: modification time the metadata was computed for (latest of source and overlay)
+        fingerprint: hash of the size, mtime, first and last blocks of the file
+    """
+
+    FIELDS = ['path', 'delimiter', 'encoding', 'compression', 'overlay', 'headers', 'row_count_estimate', 'size', 'mtime_ns', 'fingerprint']
+
+    def __init__(self, path, delimiter, encoding, compression, overlay, headers, row_count_estimate, size, mtime_ns, fingerprint):
+        self.path = path
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.compression = compression
+        self.overlay = overlay
+        self.headers = headers
+        self.row_count_estimate = row_count_estimate
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.fingerprint = fingerprint
+
+    @property
+    def has_bom(self):
+        return self.encoding == 'utf-8-sig'
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{field: d[field] for field in cls.FIELDS})
+
+    def __repr__(self):
+        return f"TableMetadata({self.path}, delimiter={self.delimiter!r}, headers={self.headers})"
+
+
+def _stat(path):
+    overlay = read_header_overlay(path)
+    if overlay is not None:
+        size, mtime_ns = _stat(overlay['source'])
+        return size, max(mtime_ns, os.stat(path + OVERLAY_SUFFIX).st_mtime_ns)
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _sniff(path, size, mtime_ns):
+    overlay = read_header_overlay(path)
+    source = path if overlay is None else overlay['source']
+    with open(source, 'rb') as f:
+        raw_head = f.read(PEEK_BYTES)
+        tail = b''
+        if size > PEEK_BYTES:
+            f.seek(max(PEEK_BYTES, size - PEEK_BYTES))
+            tail = f.read()
+
+    compression = detect_compression(source, raw_head)
+    head = raw_head
+    data_size = size
+    if compression == 'zip':
+        with zipfile.ZipFile(source) as archive:
+            member = _first_member(archive)
+            data_size = member.file_size
+            with archive.open(member) as f:
+                head = f.read(PEEK_BYTES)
+    elif compression is not None:
+        head, ratio = _inflate_head(source, compression)
+        data_size = len(head) if len(head) < PEEK_BYTES else round(size * ratio)
+
+    sidecar = None
+    if overlay is not None:
+        sidecar = os.path.abspath(path + OVERLAY_SUFFIX)
+        header = (overlay['header'] + '\n').encode('utf-8')
+        body = head.split(b'\n', 1)[1] if b'\n' in head else b''
+        data_size += len(header) - (len(head) - len(body))
+        head = header + body
+        raw_head += header  # the fingerprint covers the replaced header
+
+    encoding = 'utf-8-sig' if head.startswith(codecs.BOM_UTF8) else 'utf-8'
+    # universal newlines, as the text-mode reads this replaces did
+    text = head.decode(encoding, errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+
+    dialect = csv.Sniffer().sniff(text[:SNIFF_BYTES])
+    reader = csv.reader(io.StringIO(text), delimiter=dialect.delimiter)
+    headers = [col.strip() for col in next(reader, [])]
+
+    # extrapolate the row count from the average size of the complete lines we peeked at
+    lines = head.split(b'\n')
+    complete = lines[:-1] if data_size > len(head) else [line for line in lines if line.strip()]
+    row_count_estimate = 0
+    if len(complete) > 1:
+        avg_line = sum(len(line) + 1 for line in complete) / len(complete)
+        row_count_estimate = max(0, round(data_size / avg_line) - 1)
+
+    # the sampled blocks miss same-size edits in the middle of the file; the mtime doesn't
+    fingerprint = hashlib.sha256(f"{size}:{mtime_ns}:".encode() + raw_head + tail).hexdigest()
+
+    return TableMetadata(os.path.abspath(path), dialect.delimiter, encoding, compression, sidecar, headers, row_count_estimate, size, mtime_ns, fingerprint)
+
+
+class TableMetadataRegistry:
+    """
+    Sniffs each csv file once and caches its metadata in memory and on disk.
+    Entries are revalidated against the file's size and mtime (a stat, not an open).
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._entries = None  # {abs path: TableMetadata}
+        self._lock = threading.RLock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        if self.cache_file is None:
+            self.cache_file = os.path.join(get_cache_dir(), METADATA_CACHE_FILE)
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self._entries = {path: TableMetadata.from_dict(d) for path, d in json.load(f).items()}
+            except (ValueError, KeyError, TypeError):
+                self._entries = {}
+
+    def _save(self):
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({path: meta.to_dict() for path, meta in self._entries.items()}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        size, mtime_ns = _stat(path)
+
+        with self._lock:
+            self._load()
+            meta = self._entries.get(path)
+            if meta is not None and meta.size == size and meta.mtime_ns == mtime_ns:
+                return meta
+
+            meta = _sniff(path, size, mtime_ns)
+            self._entries[path] = meta
+            try:
+                self._save()
+            except OSError:
+                pass  # the on-disk cache is best effort
+            return meta
+
+    def invalidate(self, path=None):
+        with self._lock:
+            self._load()
+            if path is None:
+                self._entries = {}
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+
+_registry = TableMetadataRegistry()
+
+
+def get_table_metadata(path) -> TableMetadata:
+    """
+    Metadata (dialect, encoding, headers, row estimate, fingerprint) for the csv at `path`
+    """
+
+    return _registry.get(path)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sys
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# the table_joins modules import each other by bare name
+for path in (ROOT, os.path.join(ROOT, 'table_joins')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients hang up once they've read what they need
+
+
+class FileServer:
+    """
+    Local HTTP server serving `files` ({path with query: bytes}), which can be
+    changed while it runs. With `validators` responses carry an ETag and
+    Last-Modified and conditional requests are honoured; with `ranges` Range (and
+    If-Range) requests are.
+
+    Fields:
+        requests: (path, request headers) of every request received
+    """
+
+    def __init__(self, validators=True, ranges=True):
+        self.files = {}
+        self.validators = validators
+        self.ranges = ranges
+        self.requests = []
+
+        self._server = _QuietServer(('127.0.0.1', 0), self._handler())
+        self._thread = None
+
+    def url(self, path=''):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def paths_requested(self):
+        return [path for path, _ in self.requests]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b'', headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                data = server.files.get(self.path)
+                if data is None:
+                    return self._send(404, b'not found')
+
+                etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+                headers = []
+                if server.validators:
+                    headers = [('ETag', etag), ('Last-Modified', formatdate(0, usegmt=True))]
+                    if self.headers.get('If-None-Match') == etag:
+                        return self._send(304, headers=headers)
+
+                byte_range = self.headers.get('Range') if server.ranges else None
+                if byte_range is not None and self.headers.get('If-Range') not in (None, etag):
+                    byte_range = None  # changed since the client's copy: send it all
+                if byte_range is None:
+                    return self._send(200, data, headers)
+
+                start, end = byte_range[len('bytes='):].split('-')
+                start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+                if start >= len(data):
+                    return self._send(416, headers=[('Content-Range', f"bytes */{len(data)}")])
+                headers.append(('Content-Range', f"bytes {start}-{end}/{len(data)}"))
+                self._send(206, data[start:end + 1], headers)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer().start()
+    yield server
+    server.stop()
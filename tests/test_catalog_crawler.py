@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from data_collection.scraper import CatalogCrawler, generate_scraped_urls, parse_results_page
+from file_processing.utils.download_cache import DownloadCache
+
+TOPIC = "electric vehicle"
+PAGES = 3
+
+PAGE_1_LINKS = [
+    "https://data.wa.gov/api/views/f6w7-q2d2/rows.csv?accessType=DOWNLOAD",
+    "https://data.wa.gov/api/views/d886-d5cm/rows.csv?accessType=DOWNLOAD",
+]
+ALL_LINKS = PAGE_1_LINKS + [
+    "https://data.wa.gov/api/views/rpr4-cgyd/rows.csv?accessType=DOWNLOAD",
+    "https://data.austintexas.gov/api/views/tptb-nagm/rows.csv?accessType=DOWNLOAD",
+    "https://data.austintexas.gov/api/views/tptb-nagm/rows.csv?accessType=DOWNLOAD&bom=true",
+]
+
+
+def saved_page(page):
+    with open(os.path.join(FIXTURES_DIR, 'catalog', f"electric_vehicle_page_{page}.html"), 'rb') as f:
+        return f.read()
+
+
+def page_path(file_server, page):
+    url = urlparse(CatalogCrawler(base_url=file_server.url(), use_cache=False).page_url(TOPIC, page))
+    return f"{url.path}?{url.query}"
+
+
+def serve_catalog(file_server):
+    for page in range(1, PAGES + 1):
+        file_server.files[page_path(file_server, page)] = saved_page(page)
+
+
+def crawl(**crawler_kwargs):
+    async def run():
+        async with CatalogCrawler(**crawler_kwargs) as crawler:
+            return [link async for link in crawler.crawl(TOPIC)]
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('parser', ['html.parser', 'lxml'])
+def test_parse_saved_results_page(parser):
+    # csv resources only, skipping datasets without resources
+    assert parse_results_page(saved_page(1), parser) == (PAGE_1_LINKS, 3)
+    assert parse_results_page(saved_page(3), parser)[1] == 3
+
+
+def test_crawl_follows_pagination(file_server):
+    serve_catalog(file_server)
+    links = crawl(base_url=file_server.url(), delay=0, use_cache=False)
+
+    assert links[:2] == PAGE_1_LINKS  # yielded before the other pages are fetched
+    assert sorted(links) == sorted(ALL_LINKS)  # each link once
+    assert len(file_server.requests) == PAGES
+
+
+def test_crawl_stops_at_max_pages(file_server):
+    serve_catalog(file_server)
+    links = crawl(base_url=file_server.url(), delay=0, max_pages=2, use_cache=False)
+    assert len(file_server.requests) == 2
+    assert "https://data.austintexas.gov/api/views/tptb-nagm/rows.csv?accessType=DOWNLOAD" not in links
+
+
+def test_crawl_follows_windowed_pagination_until_results_run_out(file_server):
+    # each page only links to the next one; page 6 repeats page 5's results
+    def page_html(page, results):
+        datasets = "".join(
+            f'<div class="dataset-content"><ul class="dataset-resources">'
+            f'<li><a href="https://example.com/{result}.csv" data-format="csv">CSV</a></li></ul></div>'
+            for result in results
+        )
+        return f'{datasets}<div class="pagination"><a href="?page={page + 1}">{page + 1}</a></div>'.encode()
+
+    for page in range(1, 8):
+        file_server.files[page_path(file_server, page)] = page_html(page, [min(page, 5)])
+    links = crawl(base_url=file_server.url(), delay=0, use_cache=False)
+
+    assert links == [f"https://example.com/{result}.csv" for result in range(1, 6)]
+    assert len(file_server.requests) == 6
+
+
+def test_crawl_skips_missing_pages(file_server):
+    serve_catalog(file_server)
+    del file_server.files[page_path(file_server, 2)]
+    links = crawl(base_url=file_server.url(), delay=0, use_cache=False)
+    assert "https://data.wa.gov/api/views/rpr4-cgyd/rows.csv?accessType=DOWNLOAD" not in links
+    assert len(links) == 4
+
+
+def test_crawl_requests_are_spaced(file_server):
+    serve_catalog(file_server)
+    start = time.monotonic()
+    crawl(base_url=file_server.url(), delay=0.2, use_cache=False)
+    assert time.monotonic() - start >= 0.2 * (PAGES - 1)
+
+
+def test_rerun_uses_the_download_cache(file_server, tmp_path):
+    serve_catalog(file_server)
+    cache = DownloadCache(cache_dir=str(tmp_path))
+    output_file = str(tmp_path / "links.txt")
+
+    generate_scraped_urls(TOPIC, output_file, base_url=file_server.url(), delay=0, cache=cache)
+    with open(output_file) as f:
+        assert sorted(f.read().split()) == sorted(ALL_LINKS)
+    assert len(file_server.requests) == PAGES
+
+    assert sorted(crawl(base_url=file_server.url(), delay=0, cache=cache)) == sorted(ALL_LINKS)
+    assert len(file_server.requests) == PAGES  # fresh pages aren't requested again
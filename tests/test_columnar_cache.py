@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+from csv_helpers import read_csv
+from table_metadata import PEEK_BYTES
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('SMART_GATHER_CACHE_DIR', str(tmp_path / "cache"))
+
+
+def test_same_size_edit_in_the_middle_is_not_served_stale(tmp_path):
+    # big enough that the middle row is outside the sampled first and last blocks
+    rows = [f"{i},{'a' * 20}" for i in range(20000)]
+    path = str(tmp_path / "data.csv")
+    with open(path, 'w') as f:
+        f.write("id,text\n" + "\n".join(rows) + "\n")
+    assert os.path.getsize(path) > 4 * PEEK_BYTES
+
+    assert read_csv(path)['text'][10000] == 'a' * 20
+    assert os.listdir(tmp_path / "cache" / "columnar")
+    assert read_csv(path)['text'][10000] == 'a' * 20  # from the cache
+
+    rows[10000] = f"10000,{'b' * 20}"
+    with open(path, 'w') as f:
+        f.write("id,text\n" + "\n".join(rows) + "\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))  # coarse filesystem clocks
+
+    assert read_csv(path)['text'][10000] == 'b' * 20
@@ -0,0 +1,118 @@
+import pytest
+
+from file_processing.create_er_csv import create_er_csv
+from file_processing.utils import download_cache
+from file_processing.utils.download_cache import DownloadCache, SourceChangedError
+
+DATA = b"id,name\n" + b"".join(b"%d,row %d\n" % (i, i) for i in range(5000))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(cache_dir=str(tmp_path))
+
+
+def read(cache, url, n=None):
+    with cache.open(url) as f:
+        return f.read() if n is None else f.read(n)
+
+
+@pytest.mark.parametrize('validators', [True, False])
+def test_complete_download_is_kept(file_server, cache, validators):
+    file_server.validators = validators
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+
+    assert read(cache, url) == DATA
+    assert read(cache, url) == DATA
+    assert len(file_server.requests) == 1
+    assert cache.entry(url)['complete']
+    assert cache.stats()['hits'] == 1
+
+
+def test_stale_copy_is_revalidated(file_server, cache):
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+    read(cache, url)
+
+    cache.max_age = -1  # everything is stale
+    assert read(cache, url) == DATA
+    assert 'If-None-Match' in file_server.requests[-1][1]
+    assert cache.revalidated == 1
+    assert cache.bytes_downloaded == len(DATA)
+
+
+def test_stale_copy_without_validators_is_downloaded_again(file_server, cache):
+    file_server.validators = False
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+    read(cache, url)
+
+    cache.max_age = -1
+    file_server.files['/data.csv'] = DATA + b"5000,row 5000\n"
+    assert read(cache, url) == file_server.files['/data.csv']
+    assert len(file_server.requests) == 2
+
+
+def test_partial_download_is_resumed(file_server, cache):
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+
+    assert read(cache, url, 100) == DATA[:100]
+    assert cache.entry(url)['size'] == 100
+    assert read(cache, url, 100) == DATA[:100]  # from disk
+    assert len(file_server.requests) == 1
+
+    assert read(cache, url) == DATA
+    assert file_server.requests[-1][1]['Range'] == 'bytes=100-'
+    assert cache.resumed == 1
+    assert cache.entry(url)['complete']
+
+
+def test_partial_download_without_validators_is_discarded(file_server, cache):
+    file_server.validators = False
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+
+    assert read(cache, url, 100) == DATA[:100]
+    assert cache.entry(url) is None
+
+
+def test_changed_file_is_downloaded_from_the_start(file_server, cache):
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+    read(cache, url, 100)
+
+    cache.max_age = -1  # so the partial copy is checked before it's read
+    changed = b"id,title\n" + DATA[8:]
+    file_server.files['/data.csv'] = changed
+    assert read(cache, url) == changed  # If-Range fails, so the server sends it all
+    assert cache.resumed == 0
+
+
+def test_file_changed_while_being_read_raises(file_server, cache):
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+    read(cache, url, 100)
+
+    changed = b"id,title\n" + DATA[8:]
+    file_server.files['/data.csv'] = changed
+    with pytest.raises(SourceChangedError, match="changed while it was being read"):
+        read(cache, url)
+    assert cache.entry(url) is None
+    assert read(cache, url) == changed  # downloaded from scratch
+
+
+def test_create_er_csv_retries_a_file_changed_while_being_read(file_server, cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_cache, '_cache', cache)
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+    read(cache, url, 100)
+
+    file_server.files['/data.csv'] = DATA.replace(b"row", b"line")
+    schema_headers = {'default_pk': [], 'non_default_pk': ['Name']}
+    create_er_csv(str(tmp_path), schema_headers, url, {'Name': ('name', 1.0)}, max_rows=100)
+
+    [output_file] = tmp_path.glob("schema_*.csv")
+    assert output_file.read_text().splitlines()[:3] == ['Name', 'line 0', 'line 1']
+    assert len(file_server.requests) == 3  # the first download, the failed resume and the new download
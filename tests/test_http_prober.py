@@ -0,0 +1,90 @@
+import asyncio
+import gzip
+import io
+import zipfile
+
+import pytest
+
+from file_processing.utils.download_cache import DownloadCache
+from file_processing.utils.http_prober import HeaderProber, parse_header, probe_headers
+
+HEADER = ["id", "name", "value"]
+ROWS = b"".join(b"%d,row %d,%d\n" % (i, i, i * 3) for i in range(50000))
+DATA = b",".join(col.encode() for col in HEADER) + b"\n" + ROWS
+
+
+def zipped(data):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('data.csv', data)
+    return buffer.getvalue()
+
+
+def test_parse_header():
+    assert parse_header(DATA[:100]) == HEADER
+    assert parse_header(DATA[:5]) is None  # the header row isn't all there
+    assert parse_header(gzip.compress(DATA)[:2000], 'data.csv.gz') == HEADER
+
+
+def test_probe_reads_only_the_first_range(file_server):
+    file_server.files['/data.csv'] = DATA
+    assert probe_headers([file_server.url('/data.csv')], use_cache=False) == [HEADER]
+    assert len(file_server.requests) == 1
+    assert file_server.requests[0][1]['Range'] == 'bytes=0-16383'
+
+
+def test_probe_without_range_support(file_server):
+    file_server.ranges = False
+    file_server.files['/data.csv'] = DATA
+    assert probe_headers([file_server.url('/data.csv')], use_cache=False) == [HEADER]
+
+
+def test_probe_grows_the_range_for_long_headers(file_server):
+    header = [f"column_{i}" for i in range(3000)]
+    file_server.files['/wide.csv'] = ",".join(header).encode() + b"\n" + ROWS
+    assert probe_headers([file_server.url('/wide.csv')], use_cache=False) == [header]
+    assert len(file_server.requests) == 2
+
+
+@pytest.mark.parametrize('path, data', [
+    ('/data.csv.gz', gzip.compress(DATA)),
+    ('/data.zip', zipped(DATA)),
+    ('/download?id=1', gzip.compress(DATA)),  # found by its magic bytes
+])
+def test_probe_compressed(file_server, path, data):
+    file_server.files[path] = data
+    assert probe_headers([file_server.url(path)], use_cache=False) == [HEADER]
+
+
+def test_probe_errors_are_returned_in_order(file_server):
+    file_server.files['/data.csv'] = DATA
+    file_server.files['/empty.csv'] = b""
+    urls = [file_server.url(path) for path in ('/missing.csv', '/data.csv', '/empty.csv')]
+    missing, headers, empty = probe_headers(urls, use_cache=False)
+    assert isinstance(missing, Exception)
+    assert headers == HEADER
+    assert empty == []
+
+
+def test_probe_timeout(file_server):
+    async def probe():
+        async with HeaderProber(base_url=file_server.url(), timeout=1e-6, use_cache=False) as prober:
+            return await prober.probe('/data.csv')
+
+    file_server.files['/data.csv'] = DATA
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(probe())
+
+
+def test_probe_through_the_download_cache(file_server, tmp_path):
+    cache = DownloadCache(cache_dir=str(tmp_path))
+    file_server.files['/data.csv'] = DATA
+    url = file_server.url('/data.csv')
+
+    assert probe_headers([url], cache=cache) == [HEADER]
+    assert probe_headers([url], cache=cache) == [HEADER]
+    assert len(file_server.requests) == 1
+    assert cache.entry(url)['size'] == 16384  # kept as a resumable partial
+
+    assert probe_headers([url], cache=cache, use_cache=False) == [HEADER]
+    assert len(file_server.requests) == 2
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+# entry point -> import time budget in milliseconds
+BUDGETS_MS = {
+    'demo': 50,
+    'data_collection.scraper': 75,  # asyncio alone takes ~40 ms
+    'file_processing.create_er_csv': 200,  # numpy and asyncio
+}
+
+# must only be imported by the code paths that use them
+LAZY_MODULES = ['pandas', 'scipy', 'openai', 'dotenv', 'erdantic', 'bs4', 'requests', 'httpx', 'lxml', 'pyarrow']
+
+RUNS = 3  # the fastest run is compared to the budget, as the others are mostly noise
+
+
+def import_times(module):
+    """
+    Parse the `python -X importtime` report of importing `module` in a fresh
+    interpreter into [(module, self us, cumulative us), ...], leaving out the
+    interpreter's own startup imports
+    """
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=ROOT
+    )
+    assert result.returncode == 0, f"importing {module} failed:\n{result.stderr}"
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name == ' site':  # everything so far was interpreter startup
+            times = []
+            continue
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+@pytest.mark.parametrize('module', BUDGETS_MS)
+def test_heavy_dependencies_are_imported_lazily(module):
+    imported = set(name.split('.')[0] for name, _, _ in import_times(module))
+    assert [lazy for lazy in LAZY_MODULES if lazy in imported] == []
+
+
+@pytest.mark.parametrize('module, budget_ms', BUDGETS_MS.items())
+def test_import_time_budget(module, budget_ms):
+    total_ms = min(sum(self_us for _, self_us, _ in import_times(module)) / 1000 for _ in range(RUNS))
+    assert total_ms <= budget_ms, f"{module} took {total_ms:.1f} ms to import, over its {budget_ms} ms budget"
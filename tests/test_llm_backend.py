@@ -0,0 +1,84 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from conftest import FIXTURES_DIR, ROOT
+from llm_backend import OpenAIBackend, ReplayBackend, StubBackend, StubLLMServer, set_llm_backend
+from llm_client import AsyncLLMClient
+
+MODEL = "gpt-4"
+HEADER_PROMPT = "Suggest a better name for this column.\nHeader: Value\nSample rows:\n0.91\n0.95\n"
+JOIN_PROMPT = "Output the answer only as a list of length-two tuples, with no other output.\n"
+
+# the UN demo files, and the GPT answer recorded for joining them
+RATIO_FILE = os.path.join(ROOT, 'demo_data', "Ratio of girls to boys in education.csv")
+SEATS_FILE = os.path.join(ROOT, 'demo_data', "Seats held by women in Parliament.csv")
+UN_SCHEMA_HEADERS = ["Year", "Country", "Education level", "Gender ratio", "Percentage women"]
+UN_FILES_TO_MATCHES = {
+    RATIO_FILE: [("Year", "Year"), ("Series", "Education level"), ("Value", "Gender ratio")],
+    SEATS_FILE: [("Value", "Percentage women")],
+}
+UN_REPLAY_FILE = os.path.join(FIXTURES_DIR, 'llm', 'un_join_replay.json')
+
+
+def request(prompt):
+    return {'model': MODEL, 'messages': [{'role': 'system', 'content': prompt}], 'temperature': 0, 'max_tokens': 64}
+
+
+@pytest.fixture
+def stub_server():
+    with StubLLMServer() as server:
+        yield server
+
+
+@pytest.fixture
+def llm_backend():
+    yield set_llm_backend
+    set_llm_backend(None)
+
+
+def test_stub_server_speaks_the_openai_api(stub_server):
+    backend = OpenAIBackend(api_key="stub", base_url=stub_server.base_url)
+    assert backend.complete(**request(HEADER_PROMPT)) == "Value"
+    assert backend.complete(**request(JOIN_PROMPT)) == "[]"
+    assert asyncio.run(backend.acomplete(**request(HEADER_PROMPT))) == "Value"
+    assert stub_server.requests == 3
+
+
+def test_client_retries_injected_rate_limits():
+    with StubLLMServer(error_rate=0.5, seed=1) as server:
+        client = AsyncLLMClient(backend=StubBackend(server=server), base_delay=0.01, max_retries=10)
+        contents = asyncio.run(client.complete_all([request(HEADER_PROMPT)] * 10))
+
+    assert contents == ["Value"] * 10
+    assert server.errors > 0
+    assert client.retries == server.errors
+
+
+def test_replay_serves_recorded_responses(tmp_path):
+    backend = ReplayBackend(UN_REPLAY_FILE, latency=0.01)
+    with pytest.raises(KeyError):
+        backend.complete(**request(JOIN_PROMPT))
+
+    # misses go to the fallback and are recorded
+    replay_file = str(tmp_path / "replay.json")
+    shutil.copy(UN_REPLAY_FILE, replay_file)
+    with StubLLMServer() as server:
+        recording = ReplayBackend(replay_file, fallback=StubBackend(server=server))
+        assert recording.complete(**request(JOIN_PROMPT)) == "[]"
+        assert ReplayBackend(replay_file).complete(**request(JOIN_PROMPT)) == "[]"
+        assert server.requests == 1
+
+
+def test_gpt_join_replays_the_recorded_plan(llm_backend):
+    import gpt_join
+
+    llm_backend(ReplayBackend(UN_REPLAY_FILE))
+    csv_headers = {file: gpt_join.get_headers(file) for file in UN_FILES_TO_MATCHES}
+    intersections = gpt_join.find_header_intersection_gpt(UN_SCHEMA_HEADERS, csv_headers, UN_FILES_TO_MATCHES)
+
+    assert intersections == {
+        (RATIO_FILE, SEATS_FILE): [("Year", "Year", 1), ("Region/Country/Area", "Region/Country/Area", 1)],
+    }
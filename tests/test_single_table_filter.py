@@ -0,0 +1,17 @@
+import pandas as pd
+
+from single_table_filter import SingleTableFilter
+
+
+def test_stream_result_drops_duplicates_across_chunks(tmp_path):
+    # `a` parses as int64 in the first chunk and as float64 in the second
+    path = str(tmp_path / "data.csv")
+    with open(path, 'w') as f:
+        f.write("a,b\n1,x\n2,y\n1,x\n,z\n")
+    output_file = str(tmp_path / "out.csv")
+
+    table_filter = SingleTableFilter({path: [('a', 'A'), ('b', 'B')]}, ['A', 'B'])
+    assert table_filter.stream_result(output_file, chunksize=2) == 3
+
+    out = pd.read_csv(output_file)
+    assert out['B'].tolist() == ['x', 'y', 'z']